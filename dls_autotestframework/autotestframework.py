@@ -16,7 +16,7 @@ import cothread
 from cothread import *
 from cothread.catools import *
 import cothread.coselect
-import re, os, socket, sys
+import re, os, socket, sys, errno
 import inspect
 import shlex
 from datetime import *
@@ -31,11 +31,20 @@ import socket
 from runtests import *
 from xml.dom.minidom import *
 import urllib
-import pyclbr
 import traceback
 import telnetlib
 import getopt
 import fcntl
+import json
+import collections
+import atexit
+import weakref
+import mmap
+import tempfile
+import signal
+import hashlib
+import glob
+from xml.sax.saxutils import escape, quoteattr
 
 helpText = """
 Execute an automatic test suite.  Options are:
@@ -48,6 +57,30 @@ Execute an automatic test suite.  Options are:
 -t <target>   Tests only on specified <target>
 --hudson      The test suite is running under Hudson
 -c <case>     Execute this case, may be specified multiple times
+--concurrent <n>  Run up to <n> independent cases at the same time
+--fail-fast <n>   Stop testing a target after <n> failures, the remaining
+                  cases are reported as skipped
+--skip-all    Report every case as skipped without preparing the targets
+--deps <file> Write the files the suite depends on to <file>
+--pool <socket>   Attach to IOCs and simulations kept running by the
+                  RunTests entity pool listening on <socket>
+--events      Also send structured events to the result server
+--resources   Report the CPU time, memory and file descriptors used
+                  by the test, IOC and simulation processes in each case
+--log-sync <policy>  When console logs are synchronised to disc: always
+                  (every write), interval (every second, the default),
+                  close (when the connection is closed) or never
+--spill <directory>  Write process output to segment files under the
+                  directory, keeping only the most recent in memory
+--incremental Skip builds whose directory is unchanged since its last
+                  successful build
+--build-jobs <n>  Run up to <n> builds of the same phase at once
+--echo <policy>  How IOC and simulation console output is echoed: all
+                  (the default), off, level:<n> (only when the -d level
+                  is at least <n>) or rate:<n> (at most <n> lines a
+                  second from each process, counting those dropped)
+--trace <file>    Write the time taken by each entity build, run, prepare
+                  and destroy to <file> as Chrome trace events
 """
 
 def getClassName(object):
@@ -65,20 +98,97 @@ phaseNormal = 2
 phaseLate = 3
 phaseVeryLate = 4
 
-def killProcessAndChildren(pid):
-    # First, kill off all the children
-    str = subprocess.Popen('ps -o pid,ppid ax', shell=True, stdout=subprocess.PIPE).communicate()[0]
-    lines = str.split('\n')[1:]
-    for line in lines:
-        pids = line.strip().split()
-        if len(pids) == 2 and int(pids[1]) == pid:
-            killProcessAndChildren(int(pids[0]))
-    # If the parent still exists, kill it too
-    str = subprocess.Popen('ps %s' % pid, shell=True, stdout=subprocess.PIPE).communicate()[0]
-    lines = str.split('\n')
-    if len(lines) > 1:
-        p = subprocess.Popen("kill -KILL %d" % pid, shell=True)
-        p.wait()
+def readProcessTable():
+    '''Returns a dictionary mapping each process id to the fields of its
+    /proc/<pid>/stat line that follow the command name.'''
+    result = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                text = open('/proc/%s/stat' % entry).read()
+            except IOError:
+                # The process has gone
+                continue
+            result[int(entry)] = text[text.rfind(')')+2:].split()
+    return result
+
+def processTree(pid, table):
+    '''Returns the process id and those of all its descendants.'''
+    children = {}
+    for child, fields in table.iteritems():
+        children.setdefault(int(fields[1]), []).append(child)
+    result = []
+    todo = [pid]
+    while len(todo) > 0:
+        p = todo.pop()
+        if p in table:
+            result.append(p)
+            todo.extend(children.get(p, []))
+    return result
+
+def sampleProcessResources(pid, table, descendants=True):
+    '''Returns a tuple of the CPU time in seconds, the resident set size in
+    bytes and the number of open file descriptors of a process and, if
+    requested, its descendants.  The table is that returned by
+    readProcessTable.'''
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    pageSize = os.sysconf('SC_PAGE_SIZE')
+    cpu = 0.0
+    rss = 0
+    fds = 0
+    pids = [pid]
+    if descendants:
+        pids = processTree(pid, table)
+    for p in pids:
+        fields = table[p]
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * pageSize
+        try:
+            fds += len(os.listdir('/proc/%s/fd' % p))
+        except OSError:
+            pass
+    return (cpu, rss, fds)
+
+def processAlive(pid):
+    '''Returns True if the process exists and is not a zombie.'''
+    try:
+        text = open('/proc/%d/stat' % pid).read()
+    except IOError:
+        return False
+    return text[text.rfind(')')+2:].split()[0] != 'Z'
+
+def signalProcesses(leader, pids, sig, ownGroup=False):
+    '''Sends the signal to the process group led by the leader, if it
+    leads one other than our own, and to each of the processes.  When
+    ownGroup is set the leader was started in a session of its own, so the
+    group is signalled by its id even if the leader has already gone.'''
+    try:
+        if ownGroup or (os.getpgid(leader) == leader and leader != os.getpgrp()):
+            os.killpg(leader, sig)
+    except OSError:
+        pass
+    for pid in pids:
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+def killProcessAndChildren(pid, gracePeriod=2.0, ownGroup=False):
+    '''Terminates a process and its descendants.  Children started in a
+    session of their own, as are those with ownGroup set, are signalled
+    as a group; descendants found
+    through /proc, including any that have left the group, are signalled
+    individually.  Those still alive after the grace period for SIGTERM
+    are sent SIGKILL.'''
+    processes = processTree(pid, readProcessTable())
+    signalProcesses(pid, processes, signal.SIGTERM, ownGroup)
+    deadline = time.time() + gracePeriod
+    alive = [p for p in processes if processAlive(p)]
+    while len(alive) > 0 and time.time() < deadline:
+        Sleep(0.1)
+        alive = [p for p in alive if processAlive(p)]
+    # Also catches group members that were orphaned before the scan
+    signalProcesses(pid, alive, signal.SIGKILL, ownGroup)
 
 ################################################
 # Epics database record
@@ -389,12 +499,39 @@ class EpicsDatabase(object):
                 if token == ")":
                     item.addField(name, value)
 
+################################################
+# Test case registration
+# Maps a module name to the concrete test case classes it defines, in
+# the order they were defined.
+registeredTestCases = {}
+
+class TestCaseRegistry(type):
+    '''Metaclass of TestCase that records each concrete test case class
+    as it is defined.  Classes with a name ending in 'Base' are treated
+    as abstract and not recorded.'''
+
+    def __init__(cls, name, bases, dict):
+        type.__init__(cls, name, bases, dict)
+        isDerived = any(isinstance(b, TestCaseRegistry) for b in bases)
+        if isDerived and not name.endswith("Base"):
+            registeredTestCases.setdefault(cls.__module__, []).append(cls)
+
 ################################################
 # Test case super class
 class TestCase(unittest.TestCase):
     '''The automatic test framework test case super class.  All test
     cases should be derived from this class.  It provides the
-    API that test cases can use during tests.'''
+    API that test cases can use during tests.
+
+    A case that can run alongside others against the same target should
+    set the class attribute independent to True, or list the resource tags
+    it uses in resources.  When the suite is run with --concurrent, such
+    cases are run as concurrent cothreads, except that cases sharing a
+    resource tag never overlap.'''
+
+    __metaclass__ = TestCaseRegistry
+    independent = False
+    resources = []
 
     def __init__(self, suite):
         # Construct the super class
@@ -403,6 +540,11 @@ class TestCase(unittest.TestCase):
         self.suite = suite
         self.suite.addTest(self)
         self.throwFail = True
+        self.caseResult = None
+
+    def canRunConcurrently(self):
+        '''Returns True if the case may overlap with other cases.'''
+        return self.independent or len(self.resources) > 0
 
     def fail(self, message):
         if self.throwFail:
@@ -489,7 +631,12 @@ class TestCase(unittest.TestCase):
 
     def diagnostic(self, text, level=0):
         '''Write the text as a TAP diagnostic line.'''
-        self.suite.diagnostic(text, level)
+        if self.caseResult is not None:
+            # Running concurrently, hold the text until the case is reported
+            if level <= self.suite.diagnosticLevel:
+                self.caseResult.diagnostic(text)
+        else:
+            self.suite.diagnostic(text, level)
 
     def param(self, name):
         '''Return a parameter.'''
@@ -578,26 +725,49 @@ class TestSuite(unittest.TestSuite):
         self.selectedCases = []
         self.results = None
         self.serverSocketName = None
-        self.resultSocket = None
+        self.resultSender = None
         self.xmlFileName = None
         self.underHudson = False
+        self.maxConcurrentCases = 1
+        self.failFast = 0
+        self.skipAll = False
+        self.dependencyFileName = None
+        self.dependencies = []
+        self.entityPool = None
+        self.entityPoolName = None
+        self.sendEvents = False
+        self.sampleResources = False
+        self.traceFileName = None
+        self.traceEvents = []
         # Parse any command line arguments
         if self.processArguments():
             # Try to open a connection to the results server
             if self.serverSocketName is not None:
-                self.resultSocket = socket.socket(socket.AF_UNIX)
-                self.resultSocket.connect((self.serverSocketName))
-            # Get the sub-class to define the tests and environment
-            self.createTests()
-            # Now run the tests
-            self.runTests()
+                self.resultSender = ResultSender(self.serverSocketName)
+            # And to the entity pool
+            if self.entityPoolName is not None:
+                self.entityPool = EntityPoolClient(self.entityPoolName)
+            try:
+                # Get the sub-class to define the tests and environment
+                self.createTests()
+                if self.dependencyFileName is not None:
+                    self.writeDependencies()
+                # Now run the tests
+                self.runTests()
+            finally:
+                # Send whatever is still queued, even after an exception
+                if self.resultSender is not None:
+                    self.resultSender.close()
 
     def processArguments(self):
         """Process the command line arguments.
         """
         try:
             opts, args = getopt.gnu_getopt(sys.argv[1:], 'd:t:c:r:hbigex:',
-                ['help', 'hudson', 'target=', 'case=', 'build', 'ioc', 'gui', 'simulation'])
+                ['help', 'hudson', 'target=', 'case=', 'build', 'ioc', 'gui', 'simulation',
+                'concurrent=', 'fail-fast=', 'skip-all', 'deps=', 'pool=', 'events',
+                'resources', 'log-sync=', 'spill=', 'echo=',
+                'incremental', 'build-jobs=', 'trace='])
         except getopt.GetoptError, err:
             return False
         for o, a in opts:
@@ -623,6 +793,38 @@ class TestSuite(unittest.TestSuite):
                 self.xmlFileName = a
             elif o in ('--hudson'):
                 self.underHudson = True
+            elif o in ('--concurrent'):
+                self.maxConcurrentCases = int(a)
+            elif o in ('--fail-fast'):
+                self.failFast = int(a)
+            elif o in ('--skip-all'):
+                self.skipAll = True
+            elif o in ('--deps'):
+                self.dependencyFileName = a
+            elif o in ('--pool'):
+                self.entityPoolName = a
+            elif o in ('--events'):
+                self.sendEvents = True
+            elif o in ('--resources'):
+                self.sampleResources = True
+            elif o in ('--log-sync'):
+                if a not in LogWriter.policies:
+                    print 'Unknown log sync policy %s.' % a
+                    return False
+                LogWriter.defaultPolicy = a
+            elif o in ('--spill'):
+                SpillBuffer.spillDirectory = a
+            elif o in ('--incremental'):
+                BuildRunner.incremental = True
+            elif o in ('--build-jobs'):
+                BuildRunner.jobs = int(a)
+            elif o in ('--trace'):
+                self.traceFileName = a
+            elif o in ('--echo'):
+                if not setEchoPolicy(a):
+                    print 'Unknown echo policy %s.' % a
+                    return False
+        ConsoleEcho.diagnosticLevel = self.diagnosticLevel
         if len(args) > 0:
             print 'Too many arguments.'
             return False
@@ -632,26 +834,62 @@ class TestSuite(unittest.TestSuite):
         '''Add a target to the test suite.'''
         self.targets.append(target)
 
+    def addDependency(self, path):
+        '''Declare a file or directory that the suite's results depend on
+        in addition to those implied by the entities.'''
+        self.dependencies.append(path)
+
+    def writeDependencies(self):
+        '''Writes the absolute paths of the files and directories the suite
+        depends on, one per line.  These are the files declared by the
+        entities of every target, any added with addDependency and the
+        Python modules that have been loaded from below the current
+        directory.'''
+        paths = set()
+        for target in self.targets:
+            for e in target.entities:
+                paths.update(e.dependencies())
+        paths.update(self.dependencies)
+        here = os.getcwd() + os.sep
+        for module in sys.modules.values():
+            fileName = getattr(module, '__file__', None)
+            if fileName is not None:
+                fileName = os.path.abspath(fileName)
+                if fileName.endswith('.pyc') or fileName.endswith('.pyo'):
+                    fileName = fileName[:-1]
+                if fileName.startswith(here):
+                    paths.add(fileName)
+        try:
+            wFile = open(self.dependencyFileName, "w")
+        except IOError:
+            pass
+        else:
+            for path in sorted(paths):
+                wFile.write("%s\n" % os.path.abspath(path))
+            wFile.close()
+
     def reportCoverage(self):
         '''Generate the coverage reports from the test run.'''
-        self.diagnostic(self.target.reportCoverage())
+        text = self.target.reportCoverage()
+        self.diagnostic(text)
+        if self.results is not None:
+            self.results.event('coverage', text=text)
 
     def autoCreateTests(self, moduleName):
         """
         Automatically create TestCase objects from the moduleName module.
         Any classes not of type TestCase, or which have a name ending
-        in 'Base' are not instantiated.
+        in 'Base' are not instantiated.  The classes are those recorded
+        as the module was imported, in the order they were defined.
         Call this function in the createTests method in a derived class
         of type TestSuite.
 
         None autoCreateTests(moduleName)
         """
-        classes = pyclbr.readmodule(moduleName)
-        for c in classes:
-            if not (c.endswith("Base")):
-                classobj = eval(c)
-                if (issubclass(classobj, TestCase)):
-                    classinstance = classobj(self)
+        if moduleName not in sys.modules:
+            __import__(moduleName)
+        for classobj in registeredTestCases.get(moduleName, []):
+            classinstance = classobj(self)
 
     def addTest(self, test):
         '''Add a test case to the suite.'''
@@ -683,17 +921,135 @@ class TestSuite(unittest.TestSuite):
         '''Runs this suite's tests.'''
         for self.target in self.targets:
             if self.onlyTarget is None or self.onlyTarget == self.target.name:
-                self.target.prepare(self.doBuild, self.runIoc, self.runGui,
-                    self.diagnosticLevel, self.runSimulation, self.underHudson, self)
-                self.diagnostic("==============================")
-                self.diagnostic("***** %s *****" % getClassName(self))
-                self.results = TestResult(self.countTestCases(), sys.stdout, self)
-                self.run(self.results)
-                self.diagnostic("==============================")
-                self.results.report()
-                self.reportCoverage()
-                self.results = None
-                self.target.destroy()
+                if self.skipAll:
+                    self.skipTests()
+                    continue
+                try:
+                    self.results = None
+                    prepareError = None
+                    try:
+                        self.target.prepare(self.doBuild, self.runIoc, self.runGui,
+                            self.diagnosticLevel, self.runSimulation, self.underHudson, self)
+                    except Exception:
+                        prepareError = sys.exc_info()
+                    self.diagnostic("==============================")
+                    self.diagnostic("***** %s *****" % getClassName(self))
+                    self.results = TestResult(self.countTestCases(), sys.stdout, self)
+                    for line in self.target.buildReport():
+                        self.diagnostic(line)
+                    self.reportTimings('Set up')
+                    if prepareError is not None:
+                        # Fail the cases rather than run them against a broken target
+                        self.diagnostic("Preparing target %s failed: %s" % (self.target.name,
+                            prepareError[1]))
+                        self.results.failCases(list(self), prepareError)
+                    elif self.maxConcurrentCases > 1:
+                        self.runConcurrently(self.results)
+                    else:
+                        self.run(self.results)
+                    if self.results.shouldStop:
+                        # Aborted early, account for the cases not run
+                        cases = list(self)
+                        self.results.skipCases(cases[self.results.testsRun:],
+                            "aborted after %s failures" % len(self.results.failures))
+                    self.diagnostic("==============================")
+                    self.results.report()
+                    self.reportCoverage()
+                finally:
+                    # Always tear the target down, even after an abort.
+                    # The results stay open to report the teardown times.
+                    try:
+                        self.target.destroy()
+                    finally:
+                        if self.results is not None:
+                            self.reportTimings('Teardown')
+                            self.results.close()
+                        self.results = None
+                        self.traceEvents += self.target.traceEvents()
+        if self.traceFileName is not None:
+            self.writeTrace()
+
+    def reportTimings(self, title):
+        '''Outputs the target's timing table as diagnostics and adds it
+        to the XML results as properties, then forgets the timings so
+        that they are reported once.'''
+        lines, properties = self.target.timingReport()
+        if len(lines) > 0:
+            self.diagnostic('%s timing:' % title)
+            for line in lines:
+                self.diagnostic('  ' + line)
+            self.results.addProperties(properties)
+        self.target.reportedTimings = len(self.target.timings)
+
+    def writeTrace(self):
+        '''Writes the collected trace events in the Chrome trace event
+        format, which chrome://tracing and Perfetto can display.'''
+        try:
+            wFile = open(self.traceFileName, 'w')
+            json.dump({'traceEvents': self.traceEvents, 'displayTimeUnit': 'ms'}, wFile)
+            wFile.close()
+        except IOError, e:
+            print 'Failed to write trace file %s: %s' % (self.traceFileName, e)
+
+    def skipTests(self):
+        '''Reports all the cases as skipped against the current target.'''
+        self.results = TestResult(self.countTestCases(), sys.stdout, self)
+        self.diagnostic("***** %s *****" % getClassName(self))
+        self.results.skipCases(list(self), "test run aborted")
+        self.results.report()
+        self.results.close()
+        self.results = None
+
+    def runConcurrently(self, result):
+        '''Runs the cases, overlapping those that allow it as cothreads.
+        Cases that are not independent run on their own.  The results of
+        each case are held back and passed to the result object in the
+        original case order so that the TAP output is correctly numbered.'''
+        records = []
+        running = []
+        busyResources = set()
+        caseDone = cothread.Event()
+        def runCase(record):
+            try:
+                record.case(record.caseResult)
+            finally:
+                record.case.caseResult = None
+                record.done = True
+            running.remove(record)
+            busyResources.difference_update(record.case.resources)
+            caseDone.Signal()
+        def reportCompleted():
+            while len(records) > 0 and records[0].done:
+                records.pop(0).caseResult.replay(result)
+        for case in self:
+            if result.shouldStop:
+                break
+            if isinstance(case, TestCase) and case.canRunConcurrently():
+                # Wait for a free slot and for the resources to be released
+                while len(running) >= self.maxConcurrentCases or \
+                        busyResources.intersection(case.resources):
+                    caseDone.Wait()
+                    reportCompleted()
+            else:
+                # Wait for everything to finish
+                while len(running) > 0:
+                    caseDone.Wait()
+                    reportCompleted()
+            record = ConcurrentCaseRecord(case, result)
+            records.append(record)
+            if isinstance(case, TestCase) and case.canRunConcurrently():
+                case.caseResult = record.caseResult
+                busyResources.update(case.resources)
+                running.append(record)
+                record.handle = Spawn(runCase, record)
+            else:
+                case(record.caseResult)
+                record.done = True
+            reportCompleted()
+        while len(running) > 0:
+            caseDone.Wait()
+            reportCompleted()
+        reportCompleted()
 
     def diagnostic(self, text, level=0):
         '''Outputs text as a TAP diagnostic line.'''
@@ -707,8 +1063,13 @@ class TestSuite(unittest.TestSuite):
         return self.target.param(name)
 
     def sendToResultServer(self, text):
-        if self.resultSocket is not None:
-            self.resultSocket.send(text)
+        if self.resultSender is not None:
+            self.resultSender.write(text)
+
+    def flushResultServer(self):
+        '''Asks for the buffered result text to be sent now.'''
+        if self.resultSender is not None:
+            self.resultSender.flush()
 
 ################################################
 # Test results class
@@ -723,36 +1084,83 @@ class TestResult(unittest.TestResult):
         self.startTime = time.time()
         self.caseStartTime = self.startTime
         self.failures = []
+        # Set up here as the Python 2.6 unittest does not record skips
+        self.skipped = []
         self.suite = suite
-        self.xmlDoc = None
-        self.xmlTop = None
+        self.failFast = suite.failFast
+        self.caseResources = None
+        self.caseEndResources = None
+        self.timeTaken = 0.0
+        self.xmlWriter = None
         if suite.xmlFileName is not None:
-            self.xmlDoc = getDOMImplementation().createDocument(None, "testsuite", None)
-            self.xmlTop = self.xmlDoc.documentElement
+            self.xmlWriter = JUnitXmlWriter(suite.xmlFileName, getClassName(suite), self.startTime)
+        self.event('suite-start', cases=self.numCases, time=self.startTime)
         self.outputText("1..%s\n" % self.numCases)
 
     def getDescription(self, test):
         '''Return a description of a test.'''
         return test.shortDescription() or str(test)
 
+    def startTest(self, test):
+        '''Called when a test case is about to run.'''
+        unittest.TestResult.startTest(self, test)
+        self.event('case-start', number=self.testsRun, case=getClassName(test))
+        if self.suite.sampleResources:
+            self.caseResources = self.sampleResources()
+
+    def sampleResources(self):
+        '''Returns the resource use of the test process and of the processes
+        owned by the target's entities, keyed by name.  The test process
+        is sampled alone as the entity processes are its children.'''
+        table = readProcessTable()
+        result = {}
+        if os.getpid() in table:
+            result['test'] = sampleProcessResources(os.getpid(), table, False)
+        if getattr(self.suite, 'target', None) is not None:
+            for name, pid in self.suite.target.processIds():
+                if pid in table:
+                    result[name] = sampleProcessResources(pid, table)
+        return result
+
+    def caseResourceUsage(self):
+        '''Reports the change in resource use over the case as a
+        diagnostic and returns it as a list of property name, value
+        pairs for the XML report.'''
+        result = []
+        if self.caseResources is not None:
+            now = self.caseEndResources
+            if now is None:
+                now = self.sampleResources()
+            parts = []
+            for name in sorted(now.keys()):
+                cpu, rss, fds = now[name]
+                startCpu, startRss, startFds = self.caseResources.get(name, (0.0, 0, 0))
+                parts.append("%s cpu %+.2fs rss %dkB(%+dkB) fds %d(%+d)" % (name,
+                    cpu - startCpu, rss / 1024, (rss - startRss) / 1024, fds, fds - startFds))
+                result += [('%s.cpu' % name, '%.3f' % (cpu - startCpu)),
+                    ('%s.rss' % name, rss), ('%s.rssDelta' % name, rss - startRss),
+                    ('%s.fds' % name, fds), ('%s.fdsDelta' % name, fds - startFds)]
+            self.diagnostic("Resources: %s" % ', '.join(parts))
+            self.caseResources = None
+            self.caseEndResources = None
+        return result
+
     def addSuccess(self, test):
         '''Called when a test case has run successfully.'''
+        timeTaken = self.caseTime()
+        properties = self.caseResourceUsage()
         self.outputText("ok %s - %s : %s\n" % (self.testsRun, getClassName(test), self.getDescription(test)))
-        if self.xmlTop is not None:
-            element = self.createCaseXmlElement(test)
+        self.event('case-end', number=self.testsRun, case=getClassName(test),
+            status='pass', duration=timeTaken)
+        if self.xmlWriter is not None:
+            self.xmlWriter.addCase(getClassName(test), timeTaken, properties=properties)
 
-    def createCaseXmlElement(self, test):
-        # Calculate the elapsed time
+    def caseTime(self):
+        '''Returns the time taken by the case that has just completed.'''
         stopTime = time.time()
         timeTaken = float(stopTime - self.caseStartTime)
         self.caseStartTime = stopTime
-        # Create the XML element
-        element = self.xmlDoc.createElement("testcase")
-        self.xmlTop.appendChild(element)
-        element.setAttribute("classname", getClassName(self.suite))
-        element.setAttribute("name", getClassName(test))
-        element.setAttribute("time", str(timeTaken))
-        return element
+        return timeTaken
 
     def addError(self, test, err):
         '''Called when a test case fails due to an unexpected exception.'''
@@ -760,25 +1168,54 @@ class TestResult(unittest.TestResult):
         if err[0] is KeyboardInterrupt:
             self.shouldStop = 1
 
+    def addSkip(self, test, reason):
+        '''Called when a test case is skipped.'''
+        self.skipped.append((test, reason))
+        timeTaken = self.caseTime()
+        properties = self.caseResourceUsage()
+        self.outputText("ok %s - %s : %s # SKIP %s\n" % (self.testsRun, getClassName(test),
+            self.getDescription(test), reason))
+        self.event('case-end', number=self.testsRun, case=getClassName(test),
+            status='skip', duration=timeTaken, message=reason)
+        if self.xmlWriter is not None:
+            self.xmlWriter.addCase(getClassName(test), timeTaken, skipped=reason,
+                properties=properties)
+
+    def skipCases(self, cases, reason):
+        '''Reports each of the cases as skipped.'''
+        for case in cases:
+            self.startTest(case)
+            self.addSkip(case, reason)
+            self.stopTest(case)
+
+    def failCases(self, cases, err):
+        '''Reports each of the cases as failed with the error.'''
+        for case in cases:
+            self.startTest(case)
+            self.addFailure(case, err)
+            self.stopTest(case)
+
     def addFailure(self, test, err):
         '''Called when a test case fails.'''
         self.failures.append(self.testsRun)
+        if self.failFast > 0 and len(self.failures) >= self.failFast:
+            self.shouldStop = True
+        timeTaken = self.caseTime()
+        properties = self.caseResourceUsage()
         for text in apply(traceback.format_exception, err):
             for line in string.split(text, "\n"):
                 self.outputText("# %s\n" % line)
         self.outputText("not ok %s - %s : %s\n" % (self.testsRun, getClassName(test), self.getDescription(test)))
-        if self.xmlTop is not None:
-            element = self.createCaseXmlElement(test)
-            errorElement = self.xmlDoc.createElement("error")
-            element.appendChild(errorElement)
-            message = traceback.format_exception_only(err[0], err[1])[-1].strip()
-            errorElement.setAttribute("message", message)
+        message = traceback.format_exception_only(err[0], err[1])[-1].strip()
+        self.event('case-end', number=self.testsRun, case=getClassName(test),
+            status='fail', duration=timeTaken, message=message)
+        if self.xmlWriter is not None:
             textList = traceback.format_exception(err[0], err[1], err[2])
             text = ""
             for line in textList:
                 text += line + '\n'
-            textElement = self.xmlDoc.createTextNode(text)
-            errorElement.appendChild(textElement)
+            self.xmlWriter.addCase(getClassName(test), timeTaken, error=(message, text),
+                properties=properties)
 
     def report(self):
         '''Output the suite summary in TAP Test::Harness style to stdout (not the stream)'''
@@ -795,72 +1232,1007 @@ class TestResult(unittest.TestResult):
             # generate a comma separated list of failed test numbers
             text += ','.join(map(str, self.failures))
             text += "\n"
-        if self.testsRun > 0:
+        if len(self.skipped) > 0:
+            text += "Skipped %s tests\n" % len(self.skipped)
+        numRun = self.testsRun - len(self.skipped)
+        if numRun > 0:
             # Now the overall summary
-            percentSuccess = float(self.testsRun-len(self.failures)) / float(self.testsRun) * 100.0
-            numPasses = self.testsRun - len(self.failures)
+            percentSuccess = float(numRun-len(self.failures)) / float(numRun) * 100.0
+            numPasses = numRun - len(self.failures)
             text += "Passed %s/%s tests, %.2f%% okay, in %.2fs\n" % \
-                (numPasses, self.testsRun, percentSuccess, timeTaken)
+                (numPasses, numRun, percentSuccess, timeTaken)
         # Output the report as diagnostic text
         if len(text) > 0:
             lines = text.split('\n')
             for line in lines:
                 self.diagnostic(line)
-        # Output the XML report if required
-        if self.xmlDoc is not None:
-            self.xmlTop.setAttribute("failures", str(len(self.failures)))
-            self.xmlTop.setAttribute("tests", str(self.testsRun))
-            self.xmlTop.setAttribute("time", str(timeTaken))
-            self.xmlTop.setAttribute("timestamp", str(self.startTime))
-            try:
-                wFile = open(self.suite.xmlFileName, "w")
-            except IOError:
-                pass
-            else:
-                self.xmlDoc.writexml(wFile, indent="", addindent="  ", newl="\n")
+        self.event('suite-end', tests=self.testsRun, failures=len(self.failures),
+            skipped=len(self.skipped), duration=timeTaken)
+        self.timeTaken = timeTaken
+
+    def addProperties(self, properties):
+        '''Adds the list of name, value pairs to the XML report.'''
+        if self.xmlWriter is not None:
+            self.xmlWriter.addProperties(properties)
+
+    def close(self):
+        '''Completes the XML report if required.  Called after report so
+        that properties of the target teardown can still be added.'''
+        if self.xmlWriter is not None:
+            self.xmlWriter.close(self.timeTaken)
+            self.xmlWriter = None
+
+    def stopTest(self, test):
+        '''Called when a test case is complete.'''
+        unittest.TestResult.stopTest(self, test)
+        self.suite.flushResultServer()
 
     def diagnostic(self, text):
         '''Output the text as a TAP diagnostic line.'''
         self.outputText("# %s\n" % text)
+        self.event('diagnostic', number=self.testsRun, text=text)
+
+    def event(self, name, **fields):
+        '''Sends a structured event to the result server if requested.  An
+        event is a JSON object on a line starting '#@ ', which TAP
+        consumers see as a comment.  Text that is not valid UTF-8, such as
+        some IOC console output, has the bad bytes replaced.'''
+        if self.suite.sendEvents:
+            for key, value in fields.items():
+                if isinstance(value, str):
+                    fields[key] = value.decode('utf-8', 'replace')
+            fields['event'] = name
+            fields['suite'] = getClassName(self.suite)
+            if getattr(self.suite, 'target', None) is not None:
+                fields['target'] = self.suite.target.name
+            self.suite.sendToResultServer('#@ %s\n' % json.dumps(fields))
 
     def outputText(self, text):
+        # Keep any echoed console output ahead of the result
+        consoleWriter.flush()
         self.stream.write(text)
         self.suite.sendToResultServer(text)
 
 ################################################
-# Class that handles a telnet connection
+# Result server sender
+class ResultSender(object):
+    '''Sends the TAP text to the RunTests result server.  Text is buffered
+    and sent by a cothread of its own when a case completes or after the
+    flush interval.  The socket is non-blocking and the sender waits for
+    it to become writable, so a busy result server never stalls the other
+    cothreads, and a short write keeps the unsent remainder for the next
+    attempt rather than losing it.'''
+
+    flushInterval = 0.5
+
+    def __init__(self, socketName):
+        self.socket = socket.socket(socket.AF_UNIX)
+        self.socket.connect((socketName))
+        self.socket.setblocking(0)
+        self.buffer = []
+        self.pending = ''
+        self.closing = False
+        self.wakeup = cothread.Event()
+        self.sender = Spawn(self.senderThread)
+
+    def write(self, text):
+        '''Queues text to be sent.'''
+        self.buffer.append(text)
+
+    def flush(self):
+        '''Sends the queued text as soon as possible.'''
+        self.wakeup.Signal()
+
+    def senderThread(self):
+        while not self.closing:
+            try:
+                self.wakeup.Wait(self.flushInterval)
+            except cothread.Timedout:
+                pass
+            self.send()
+        self.send()
+
+    def send(self):
+        if len(self.buffer) > 0:
+            self.pending += ''.join(self.buffer)
+            self.buffer = []
+        while len(self.pending) > 0:
+            cothread.coselect.select([], [self.socket], [])
+            try:
+                sent = self.socket.send(self.pending)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    continue
+                # The result server has gone, nothing more can be sent
+                self.pending = ''
+                break
+            self.pending = self.pending[sent:]
+
+    def close(self):
+        '''Sends anything outstanding and closes the connection.'''
+        self.closing = True
+        self.wakeup.Signal()
+        self.sender.Wait()
+        self.socket.close()
+
+################################################
+# JUNIT XML results writer
+class JUnitXmlWriter(object):
+    '''Writes a JUNIT compatible XML results file a test case at a time.
+    The file is kept well formed after every case: the closing testsuite
+    tag is rewritten after each new testcase element and the totals in
+    the testsuite tag, which is padded to a fixed width, are updated in
+    place.  Nothing is held in memory, and a crashed suite leaves a
+    valid file holding the cases completed so far.  Suite properties
+    reported before the first case form the properties element; those
+    reported later, such as the teardown timings, are listed in a
+    system-out element after the cases, which the schema places last.'''
+
+    headerSpare = 80
+
+    def __init__(self, fileName, suiteName, startTime):
+        self.suiteName = suiteName
+        self.startTime = startTime
+        self.tests = 0
+        self.failures = 0
+        self.skipped = 0
+        self.propertiesWritten = False
+        self.outputEnd = None
+        try:
+            self.file = open(fileName, "w")
+        except IOError:
+            self.file = None
+        else:
+            self.file.write('<?xml version="1.0" ?>\n')
+            self.headerPos = self.file.tell()
+            self.headerWidth = len(self.header(time.time() - startTime)) + self.headerSpare
+            self.writeHeader(time.time() - startTime)
+            self.casesEnd = self.file.tell()
+            self.writeTail()
+
+    def header(self, timeTaken):
+        return '<testsuite name=%s failures="%s" skipped="%s" tests="%s" time="%s" timestamp="%s"' % \
+            (quoteattr(self.suiteName), self.failures, self.skipped, self.tests,
+            timeTaken, self.startTime)
+
+    def writeHeader(self, timeTaken):
+        self.file.seek(self.headerPos)
+        self.file.write(self.header(timeTaken).ljust(self.headerWidth) + '>\n')
+
+    def writeTail(self):
+        self.file.seek(self.casesEnd)
+        self.file.write('</testsuite>\n')
+        self.file.flush()
+
+    def addProperties(self, properties):
+        '''Writes testsuite level properties.  Properties is a list of
+        name, value pairs.  Only the first set reported before any case
+        can go in the properties element, the rest are appended to the
+        system-out element.'''
+        if self.file is None or not properties:
+            return
+        if self.tests == 0 and not self.propertiesWritten:
+            text = '  <properties>\n'
+            for propertyName, value in properties:
+                text += '    <property name=%s value=%s/>\n' % \
+                    (quoteattr(propertyName), quoteattr(str(value)))
+            text += '  </properties>\n'
+            self.file.seek(self.casesEnd)
+            self.file.write(text)
+            self.propertiesWritten = True
+        else:
+            text = ''
+            for propertyName, value in properties:
+                text += escape('%s=%s\n' % (propertyName, value))
+            if self.outputEnd is None:
+                self.file.seek(self.casesEnd)
+                self.file.write('  <system-out>')
+            else:
+                self.file.seek(self.outputEnd)
+            self.file.write(text)
+            self.outputEnd = self.file.tell()
+            self.file.write('</system-out>\n')
+        self.casesEnd = self.file.tell()
+        self.writeTail()
+
+    def addCase(self, name, timeTaken, error=None, skipped=None, properties=None):
+        '''Writes a testcase element.  The error is a tuple of the message and
+        the traceback text, skipped is the reason for skipping the case and
+        properties is a list of name, value pairs.'''
+        self.tests += 1
+        if self.file is None:
+            return
+        text = ''
+        if properties:
+            text += '    <properties>\n'
+            for propertyName, value in properties:
+                text += '      <property name=%s value=%s/>\n' % \
+                    (quoteattr(propertyName), quoteattr(str(value)))
+            text += '    </properties>\n'
+        if error is not None:
+            self.failures += 1
+            text += '    <error message=%s>%s</error>\n' % (quoteattr(error[0]), escape(error[1]))
+        if skipped is not None:
+            self.skipped += 1
+            text += '    <skipped message=%s/>\n' % quoteattr(skipped)
+        element = '  <testcase classname=%s name=%s time="%s"' % \
+            (quoteattr(self.suiteName), quoteattr(name), timeTaken)
+        if len(text) > 0:
+            text = element + '>\n' + text + '  </testcase>\n'
+        else:
+            text = element + '/>\n'
+        self.file.seek(self.casesEnd)
+        self.file.write(text)
+        self.casesEnd = self.file.tell()
+        self.writeTail()
+        self.writeHeader(time.time() - self.startTime)
+        self.file.flush()
+
+    def close(self, timeTaken):
+        '''Writes the final totals and closes the file.'''
+        if self.file is not None:
+            self.writeHeader(timeTaken)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+################################################
+# Buffered case result class
+class BufferedCaseResult(unittest.TestResult):
+    '''Holds the outcome and diagnostic output of one test case that is
+    run concurrently so it can later be passed on to the suite's result
+    object in the correct order.  Resources are sampled through the
+    suite's result object as the case runs, not when it is replayed.'''
+
+    def __init__(self, result):
+        unittest.TestResult.__init__(self)
+        self.result = result
+        self.events = []
+        self.test = None
+        self.caseStartTime = None
+        self.timeTaken = 0.0
+        self.startResources = None
+        self.endResources = None
+
+    def startTest(self, test):
+        unittest.TestResult.startTest(self, test)
+        self.test = test
+        self.caseStartTime = time.time()
+        if self.result.suite.sampleResources:
+            self.startResources = self.result.sampleResources()
+
+    def stopTest(self, test):
+        unittest.TestResult.stopTest(self, test)
+        self.timeTaken = time.time() - self.caseStartTime
+        if self.startResources is not None:
+            self.endResources = self.result.sampleResources()
+
+    def addSuccess(self, test):
+        self.events.append(('addSuccess', (test,)))
+
+    def addFailure(self, test, err):
+        self.events.append(('addFailure', (test, err)))
+
+    def addError(self, test, err):
+        self.events.append(('addError', (test, err)))
+
+    def addSkip(self, test, reason):
+        self.events.append(('addSkip', (test, reason)))
+
+    def addExpectedFailure(self, test, err):
+        self.events.append(('addExpectedFailure', (test, err)))
+
+    def addUnexpectedSuccess(self, test):
+        self.events.append(('addUnexpectedSuccess', (test,)))
+
+    def diagnostic(self, text):
+        for line in string.split(text, '\n'):
+            self.events.append(('diagnostic', (line,)))
+
+    def replay(self, result):
+        '''Pass the stored events on to the real result object.'''
+        if self.test is not None:
+            result.startTest(self.test)
+            # Make the recorded case time and resource use the ones reported
+            result.caseStartTime = time.time() - self.timeTaken
+            if self.startResources is not None:
+                result.caseResources = self.startResources
+                result.caseEndResources = self.endResources
+            for name, args in self.events:
+                getattr(result, name)(*args)
+            result.stopTest(self.test)
+
+class ConcurrentCaseRecord(object):
+    '''A test case queued by the concurrent case scheduler.'''
+
+    def __init__(self, case, result):
+        self.case = case
+        self.caseResult = BufferedCaseResult(result)
+        self.handle = None
+        self.done = False
+
+################################################
+# Classes that echo child process output to the console
+class ConsoleWriter(object):
+    '''Collects text for stdout and writes it in blocks, from a cothread
+       every flushInterval seconds or once maxPending characters are
+       waiting, rather than a line at a time.'''
+    def __init__(self, flushInterval=0.5, maxPending=65536):
+        self.flushInterval = flushInterval
+        self.maxPending = maxPending
+        self.pending = []
+        self.pendingSize = 0
+        self.flusher = None
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pendingSize += len(text)
+        if self.pendingSize >= self.maxPending:
+            self.flush()
+        elif self.flusher is None:
+            self.flusher = Spawn(self.flushThread)
+            atexit.register(self.flush)
+
+    def flushThread(self):
+        while True:
+            Sleep(self.flushInterval)
+            self.flush()
+
+    def flush(self):
+        '''Writes out the collected text.'''
+        if len(self.pending) > 0:
+            text = ''.join(self.pending)
+            self.pending = []
+            self.pendingSize = 0
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+consoleWriter = ConsoleWriter()
+
+class ConsoleEcho(object):
+    '''Echoes the text received from a process or connection through the
+       console writer.  The policy, shared by all sources, is 'all',
+       'off', 'level' (only when the diagnostic level is at least
+       echoLevel) or 'rate' (at most maxRate lines a second from each
+       source, with a count of the lines not echoed).'''
+    policies = ['all', 'off', 'level', 'rate']
+    policy = 'all'
+    echoLevel = 1
+    diagnosticLevel = 9
+    maxRate = 100
+
+    def __init__(self, name=None):
+        '''A name prefixes each line with the name and shows it quoted,
+           without one the text is echoed as it is.'''
+        self.name = name
+        self.windowStart = 0.0
+        self.windowLines = 0
+        self.dropped = 0
+
+    def echo(self, text):
+        if ConsoleEcho.policy == 'off' or len(text) == 0:
+            pass
+        elif ConsoleEcho.policy == 'level' and ConsoleEcho.echoLevel > ConsoleEcho.diagnosticLevel:
+            pass
+        else:
+            if self.name is None:
+                lines = [text]
+                numLines = max(text.count('\n'), 1)
+            else:
+                lines = ['%s:o> %s\n' % (self.name, repr(line)) for line in text.split('\n')]
+                numLines = len(lines)
+            if ConsoleEcho.policy == 'rate':
+                now = time.time()
+                if now >= self.windowStart + 1.0:
+                    self.summarise()
+                    self.windowStart = now
+                    self.windowLines = 0
+                if self.windowLines + numLines > ConsoleEcho.maxRate:
+                    self.dropped += numLines
+                    lines = []
+                self.windowLines += numLines
+            if len(lines) > 0:
+                consoleWriter.write(''.join(lines))
+
+    def summarise(self):
+        '''Reports the number of lines not echoed since the last report.'''
+        if self.dropped > 0:
+            consoleWriter.write('%s: %d lines not echoed\n' % (self.name or 'console', self.dropped))
+            self.dropped = 0
+
+def setEchoPolicy(policy):
+    '''Sets the console echo policy from an --echo option value, eg.
+       'rate:50'.  Returns False if it is not recognised.'''
+    parts = policy.split(':')
+    result = parts[0] in ConsoleEcho.policies and len(parts) <= 2
+    if result and len(parts) == 2:
+        if parts[0] in ('level', 'rate') and parts[1].isdigit():
+            if parts[0] == 'level':
+                ConsoleEcho.echoLevel = int(parts[1])
+            else:
+                ConsoleEcho.maxRate = int(parts[1])
+        else:
+            result = False
+    if result:
+        ConsoleEcho.policy = parts[0]
+    return result
+
+################################################
+# Objects to be closed when the program exits, held weakly so that
+# registering one does not keep it alive.  Keyed by object id as
+# weakref.WeakSet is not available in Python 2.6.
+closeAtExit = {}
+
+def registerCloseAtExit(item):
+    '''Arranges for the item to be closed at exit if it is still alive.'''
+    key = id(item)
+    def forget(ref):
+        if closeAtExit.get(key) is ref:
+            del closeAtExit[key]
+    closeAtExit[key] = weakref.ref(item, forget)
+
+def unregisterCloseAtExit(item):
+    '''Undoes registerCloseAtExit.'''
+    ref = closeAtExit.get(id(item))
+    if ref is not None and ref() is item:
+        del closeAtExit[id(item)]
+
+def closeAllAtExit():
+    for ref in closeAtExit.values():
+        item = ref()
+        if item is not None:
+            item.close()
+
+atexit.register(closeAllAtExit)
+
+################################################
+# Class that writes console logs in the background
+class LogWriter(object):
+    '''Appends text to a log file.  Except under the 'always' policy, the
+       text is queued and written in batches by a background thread so a
+       slow file system does not hold up the receiving cothread.  The
+       policy sets when the file is synchronised to disc: 'always' after
+       every write, 'interval' every interval seconds, 'close' when the
+       writer is closed and 'never' not at all.  If the background thread
+       fails to write, later text is dropped.'''
+    policies = ['always', 'interval', 'close', 'never']
+    defaultPolicy = 'interval'
+    defaultInterval = 1.0
+
+    def __init__(self, fileName, policy=None, interval=None):
+        self.policy = policy
+        if self.policy is None:
+            self.policy = LogWriter.defaultPolicy
+        self.interval = interval
+        if self.interval is None:
+            self.interval = LogWriter.defaultInterval
+        self.file = open(fileName, 'a+')
+        self.closed = False
+        self.failed = False
+        if self.policy != 'always':
+            self.queue = Queue.Queue()
+            self.finished = thread.allocate_lock()
+            self.finished.acquire()
+            thread.start_new_thread(self.writeThread, ())
+        # Make sure queued text reaches the file however the suite exits
+        registerCloseAtExit(self)
+
+    def write(self, text):
+        if len(text) > 0 and not self.closed and not self.failed:
+            if self.policy == 'always':
+                self.file.write(text)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            else:
+                self.queue.put(text)
+
+    def writeThread(self):
+        '''Writes the queued text a batch at a time.  A None in the queue
+           ends the thread.'''
+        try:
+            self.writeQueued()
+        except (IOError, OSError), e:
+            self.failed = True
+            print 'Failed to write log file %s: %s' % (self.file.name, e)
+        finally:
+            self.finished.release()
+
+    def writeQueued(self):
+        going = True
+        lastSync = time.time()
+        unsynced = False
+        while going:
+            chunks = []
+            try:
+                if unsynced and self.policy == 'interval':
+                    chunks.append(self.queue.get(True, max(0.01, lastSync + self.interval - time.time())))
+                else:
+                    chunks.append(self.queue.get())
+                while True:
+                    chunks.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in chunks:
+                going = False
+                chunks = chunks[:chunks.index(None)]
+            if len(chunks) > 0:
+                self.file.write(''.join(chunks))
+                self.file.flush()
+                unsynced = True
+            if unsynced and self.policy != 'never' and \
+                    (not going or (self.policy == 'interval' and time.time() >= lastSync + self.interval)):
+                os.fsync(self.file.fileno())
+                lastSync = time.time()
+                unsynced = False
+
+    def close(self):
+        '''Writes out any queued text and closes the file.'''
+        if not self.closed:
+            self.closed = True
+            if self.policy != 'always':
+                self.queue.put(None)
+                self.finished.acquire()
+            unregisterCloseAtExit(self)
+            try:
+                self.file.close()
+            except IOError:
+                pass
+
+################################################
+# Class that wakes the cothreads waiting for received text
+class ArrivalNotifier(object):
+    '''Lets cothreads wait until new text is received rather than polling
+       for it.'''
+    def __init__(self):
+        self.waiters = []
+
+    def notify(self):
+        '''Wakes all the waiting cothreads.'''
+        for event in self.waiters:
+            event.Signal()
+
+    def wait(self, timeout):
+        '''Waits for up to timeout seconds for the next notification.
+           Returns True if notified, False if timed out.'''
+        event = Event()
+        self.waiters.append(event)
+        try:
+            event.Wait(timeout)
+            result = True
+        except Timedout:
+            result = False
+        finally:
+            self.waiters.remove(event)
+        return result
+
+################################################
+# Classes that search received text for any of several patterns
+class PatternMatch(object):
+    '''The result of a PatternMatcher search: the pattern that matched,
+       its index in the list, its match object and the offsets of the
+       start and end of the match in the received text.'''
+    def __init__(self, pattern, index, match, offset):
+        self.pattern = pattern
+        self.index = index
+        self.match = match
+        self.offset = offset
+        self.end = offset + match.end() - match.start()
+
+class PatternMatcher(object):
+    '''Searches text for the earliest match of any of a list of regular
+       expressions.  The patterns are compiled into one alternation so
+       the text is scanned once however many there are.  The patterns
+       may be strings or compiled expressions.  Numbered back references
+       are only supported when there is a single pattern.  Flags cannot
+       be scoped to part of an expression, so patterns compiled with
+       differing flags are searched for one at a time instead.'''
+    def __init__(self, patterns, flags=0):
+        self.patterns = list(patterns)
+        self.compiled = [re.compile(p, flags) for p in self.patterns]
+        allFlags = set([p.flags for p in self.compiled])
+        if len(self.compiled) == 1:
+            self.combined = self.compiled[0]
+        elif len(allFlags) > 1:
+            self.combined = None
+        else:
+            self.combined = re.compile('|'.join(['(?P<_p%d>%s)' % (i, p.pattern)
+                for i, p in enumerate(self.compiled)]), allFlags.pop())
+
+    def search(self, text, pos=0, offset=0):
+        '''Searches the text from pos onwards.  Returns a PatternMatch or
+           None.  The offset of the start of the text in the stream is
+           added to the reported offset.'''
+        result = None
+        if self.combined is None:
+            return self.searchEach(text, pos, offset)
+        found = self.combined.search(text, pos)
+        if found is not None:
+            if len(self.compiled) == 1:
+                index = 0
+                match = found
+            else:
+                index = int(found.lastgroup[2:])
+                # Rematch the single pattern so the match object has its groups
+                match = self.compiled[index].match(text, found.start())
+            result = PatternMatch(self.patterns[index], index, match, offset + found.start())
+        return result
+
+    def searchEach(self, text, pos, offset):
+        '''Searches for each pattern in turn, returning the earliest match
+           and, of those starting at the same place, the first pattern's.'''
+        result = None
+        for index, pattern in enumerate(self.compiled):
+            match = pattern.search(text, pos)
+            if match is not None and (result is None or match.start() < result.match.start()):
+                result = PatternMatch(self.patterns[index], index, match, offset + match.start())
+        return result
+
+def makePatternMatcher(patterns):
+    '''Returns a PatternMatcher for a pattern, a list of patterns or an
+       existing matcher.'''
+    result = patterns
+    if not isinstance(patterns, PatternMatcher):
+        if type(patterns) != type(list()):
+            patterns = [patterns]
+        result = PatternMatcher(patterns)
+    return result
+
+################################################
+# Class that keeps the recent text received from a stream
+class ReceiveBuffer(object):
+    '''Holds the text received from a stream as a ring of chunks.  Chunks
+       are only ever appended; the oldest are dropped once they lie wholly
+       before the read cursor or, if a size is given, once at least that
+       many characters are held without them.  Positions are offsets from
+       the start of the stream, so those remembered by a search stay valid
+       as old text is dropped.'''
+    # How far back a search looks again as more text arrives
+    maxLookback = 4096
+
+    def __init__(self, size=1048576):
+        self.size = size
+        self.chunks = collections.deque()
+        self.start = 0
+        self.length = 0
+        self.cursor = 0
+        self.lock = thread.allocate_lock()
+        self.arrival = ArrivalNotifier()
+
+    def append(self, text):
+        if len(text) > 0:
+            self.lock.acquire()
+            try:
+                self.chunks.append(text)
+                self.length += len(text)
+                if self.size is not None:
+                    while self.length - len(self.chunks[0]) >= self.size:
+                        self.dropChunk()
+            finally:
+                self.lock.release()
+            self.arrival.notify()
+
+    def dropChunk(self):
+        '''Drops the oldest chunk.  Call with the lock held.'''
+        discard = len(self.chunks.popleft())
+        self.start += discard
+        self.length -= discard
+
+    def end(self):
+        '''Returns the offset of the end of the received text.'''
+        return self.start + self.length
+
+    def getTextFrom(self, offset):
+        '''Returns a tuple of the offset of the start of the returned
+           text, the text to the end, and the offset the text should be
+           read from, which is at or after the given offset and the read
+           cursor.  The text starts at the read cursor when that is where
+           it is to be read from, otherwise one character earlier, so a
+           pattern anchored with ^ matches at the cursor as it would in
+           the text from the cursor on, but not at the resume offsets of
+           later searches.'''
+        self.lock.acquire()
+        try:
+            base = max(self.cursor, self.start)
+            offset = max(offset, base)
+            textStart = max(offset - 1, base)
+            position = self.start + self.length
+            parts = []
+            for chunk in reversed(self.chunks):
+                if position <= textStart:
+                    break
+                position -= len(chunk)
+                parts.append(chunk)
+        finally:
+            self.lock.release()
+        parts.reverse()
+        if len(parts) > 0 and position < textStart:
+            parts[0] = parts[0][textStart - position:]
+            position = textStart
+        return (position, ''.join(parts), offset)
+
+    def find(self, item, offset=0):
+        '''Searches for the item in the text received from the offset
+           onwards.  Returns a tuple of the offset of the item, or -1 if
+           it is not found, and the offset from which to continue the
+           search when more text arrives.'''
+        position, text, offset = self.getTextFrom(offset)
+        found = text.find(item, offset - position)
+        if found >= 0:
+            found += position
+        resume = max(offset, position + len(text) - len(item) + 1)
+        return (found, resume)
+
+    def search(self, matcher, offset=0):
+        '''Searches for any of a PatternMatcher's patterns in the text
+           received from the offset onwards.  Returns a tuple of the
+           PatternMatch or None and the offset from which to continue the
+           search when more text arrives, the start of the last incomplete
+           line or maxLookback from the end, whichever is earlier, so that
+           a match spanning lines whose parts arrive separately is found
+           as long as it is no longer than that.'''
+        position, text, offset = self.getTextFrom(offset)
+        found = matcher.search(text, offset - position, position)
+        resume = max(offset, min(position + text.rfind('\n') + 1,
+            position + len(text) - self.maxLookback))
+        return (found, resume)
+
+    def waitFor(self, matcher, timeout, offset=0):
+        '''Waits for any of a PatternMatcher's patterns to match the text
+           from the offset or the read cursor onwards, searching only new
+           text as it arrives.  Returns a PatternMatch or None if none is
+           found within the timeout.'''
+        deadline = time.time() + timeout
+        found, offset = self.search(matcher, offset)
+        timeRemaining = deadline - time.time()
+        while found is None and timeRemaining > 0.0:
+            self.arrival.wait(timeRemaining)
+            found, offset = self.search(matcher, offset)
+            timeRemaining = deadline - time.time()
+        return found
+
+    def getText(self):
+        '''Returns the text from the read cursor to the end.'''
+        position, text, offset = self.getTextFrom(0)
+        return text[offset - position:]
+
+    def discard(self, offset):
+        '''Moves the read cursor on to the offset, dropping the chunks
+           that lie wholly before it.'''
+        self.lock.acquire()
+        try:
+            self.cursor = max(self.cursor, offset)
+            while len(self.chunks) > 0 and self.start + len(self.chunks[0]) <= self.cursor:
+                self.dropChunk()
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.discard(self.end())
+
+################################################
+# Class that keeps a stream's text on disc
+class SpillBuffer(ReceiveBuffer):
+    '''A ReceiveBuffer that writes all the text to segment files in a
+       directory and keeps only a tail of it in memory.  Segments are
+       started at line boundaries.  Searches of older text map the
+       segments into memory with mmap, a line at a time being copied out
+       for a match.  Segments wholly before the read cursor are deleted,
+       as is the directory when the buffer is closed, garbage collected
+       or at exit.'''
+    spillDirectory = None
+    tailSize = 4194304
+    segmentSize = 67108864
+
+    def __init__(self, directory, tailSize=None, segmentSize=None):
+        if tailSize is None:
+            tailSize = SpillBuffer.tailSize
+        ReceiveBuffer.__init__(self, tailSize)
+        self.directory = directory
+        self.maxSegmentSize = segmentSize
+        if self.maxSegmentSize is None:
+            self.maxSegmentSize = SpillBuffer.segmentSize
+        # Each segment is a list of its stream offset, file name and length
+        self.segments = []
+        self.segmentFd = None
+        self.numSegments = 0
+        self.spilled = 0
+        self.lastLineStart = 0
+        registerCloseAtExit(self)
+
+    def append(self, text):
+        if len(text) > 0:
+            self.lock.acquire()
+            try:
+                self.spill(text)
+            finally:
+                self.lock.release()
+            ReceiveBuffer.append(self, text)
+
+    def spill(self, text):
+        '''Writes the text to the segment files.  Call with the lock held.'''
+        if self.segmentFd is not None and self.segments[-1][2] >= self.maxSegmentSize:
+            split = text.rfind('\n') + 1
+            if split > 0:
+                self.writeSegment(text[:split])
+                text = text[split:]
+                os.close(self.segmentFd)
+                self.segmentFd = None
+        if self.segmentFd is None:
+            fileName = os.path.join(self.directory, 'segment%06d' % self.numSegments)
+            self.numSegments += 1
+            self.segmentFd = os.open(fileName, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+            self.segments.append([self.spilled, fileName, 0])
+        self.writeSegment(text)
+
+    def writeSegment(self, text):
+        newline = text.rfind('\n')
+        if newline >= 0:
+            self.lastLineStart = self.spilled + newline + 1
+        self.segments[-1][2] += len(text)
+        self.spilled += len(text)
+        while len(text) > 0:
+            text = text[os.write(self.segmentFd, text):]
+
+    def readSegments(self, offset):
+        '''Returns the text from the offset to the end from the segments.'''
+        parts = []
+        for start, fileName, length in list(self.segments):
+            if start + length > offset:
+                f = open(fileName, 'rb')
+                try:
+                    f.seek(max(offset - start, 0))
+                    parts.append(f.read(length - max(offset - start, 0)))
+                finally:
+                    f.close()
+        return ''.join(parts)
+
+    def searchSegments(self, matcher, offset):
+        '''Searches the segments from the offset for any of a
+           PatternMatcher's patterns.  Returns a PatternMatch or None.'''
+        result = None
+        for start, fileName, length in list(self.segments):
+            if result is None and start + length > offset and length > 0:
+                f = open(fileName, 'rb')
+                mapped = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+                try:
+                    result = self.searchMapped(matcher, mapped, start, length,
+                        max(offset - start, 0))
+                finally:
+                    mapped.close()
+                    f.close()
+        return result
+
+    def searchMapped(self, matcher, mapped, start, length, pos):
+        '''Searches a mapped segment starting at the stream offset start
+           from pos on.  Matches are confirmed in a copy of the lines
+           holding them, which starts at the read cursor if that is on
+           the first of them and otherwise just after a newline, so that
+           ^ sees the same text as it would in memory: it matches at the
+           cursor but not at the start of a later segment.'''
+        cursor = self.cursor - start
+        if 0 < cursor < length and pos == cursor:
+            # The mapping does not start at the cursor, so try its line first
+            lineEnd = mapped.find('\n', cursor)
+            if lineEnd < 0:
+                lineEnd = length
+            result = matcher.search(mapped[cursor:lineEnd], 0, self.cursor)
+            if result is not None:
+                return result
+            pos = lineEnd
+        result = None
+        while result is None and pos <= length:
+            found = matcher.search(mapped, pos)
+            if found is None:
+                break
+            # Copy out the lines holding the match before unmapping
+            lineStart = mapped.rfind('\n', 0, found.match.start()) + 1
+            lineEnd = mapped.find('\n', found.match.end())
+            if lineEnd < 0:
+                lineEnd = length
+            if start + lineStart <= self.cursor:
+                copyStart = max(lineStart, cursor)
+                result = matcher.search(mapped[copyStart:lineEnd],
+                    found.match.start() - copyStart, start + copyStart)
+            else:
+                result = matcher.search('\n' + mapped[lineStart:lineEnd],
+                    found.match.start() - lineStart + 1, start + lineStart - 1)
+            pos = found.match.start() + 1
+        return result
+
+    def inMemory(self, offset):
+        '''Returns True if the tail in memory holds the text a search from
+           the offset needs, including the character before it.'''
+        return offset == self.cursor and offset >= self.start or offset > self.start
+
+    def getTextFrom(self, offset):
+        offset = max(offset, self.cursor)
+        if self.inMemory(offset):
+            result = ReceiveBuffer.getTextFrom(self, offset)
+        else:
+            result = (offset, self.readSegments(offset), offset)
+        return result
+
+    def search(self, matcher, offset=0):
+        offset = max(offset, self.cursor)
+        if self.inMemory(offset):
+            result = ReceiveBuffer.search(self, matcher, offset)
+        else:
+            result = (self.searchSegments(matcher, offset), max(offset,
+                min(self.lastLineStart, self.end() - self.maxLookback)))
+        return result
+
+    def discard(self, offset):
+        ReceiveBuffer.discard(self, offset)
+        self.lock.acquire()
+        try:
+            while len(self.segments) > 1 and self.segments[0][0] + self.segments[0][2] <= self.cursor:
+                os.remove(self.segments.pop(0)[1])
+        finally:
+            self.lock.release()
+
+    def __del__(self):
+        if getattr(self, 'segmentFd', None) is not None or len(getattr(self, 'segments', [])) > 0:
+            self.close()
+
+    def close(self):
+        '''Deletes the segment files and directory.'''
+        unregisterCloseAtExit(self)
+        if self.segmentFd is not None:
+            os.close(self.segmentFd)
+            self.segmentFd = None
+        for start, fileName, length in self.segments:
+            os.remove(fileName)
+        self.segments = []
+        if os.path.isdir(self.directory):
+            os.rmdir(self.directory)
+
+################################################
+# Class that manages a telnet connection
 class TelnetConnection(object):
-    '''Manage a telnet connection, placing all received text in
-       the receiveText member.'''
-    def __init__(self, host, port, logFile=None):
+    '''Manage a telnet connection, placing the most recent received text
+       in a ReceiveBuffer.'''
+    def __init__(self, host, port, logFile=None, bufferSize=1048576):
         print "Opening telnet port %s:%s" % (host, port)
         self.telnet = telnetlib.Telnet()
         self.telnet.open(host, port)
-        self.receivedText = ''
+        self.received = ReceiveBuffer(bufferSize)
+        self.console = ConsoleEcho()
         self.logFile = None
         if logFile is not None:
             print "Opening telnet log file %s" % logFile
-            self.logFile = open(logFile, 'a+')
-        self.threadId = thread.start_new_thread(self.receiveThread, ())
+            self.logFile = LogWriter(logFile)
+        #self.threadId = thread.start_new_thread(self.receiveThread, ())
+        self.threadId = Spawn(self.receiveThread)
 
     def receiveThread(self):
-        going = True
-        while going:
-            text = self.telnet.read_some()
-            going = len(text) > 0
-            print text,
-            self.receivedText += text
-            if self.logFile is not None:
-                self.logFile.write(text)
-                self.logFile.flush()
-                os.fsync(self.logFile.fileno())
+        try:
+            going = True
+            while going:
+                cothread.coselect.select([self.telnet.get_socket()], [], [])
+                try:
+                    text = self.telnet.read_very_eager()
+                except EOFError:
+                    text = ''
+                    going = False
+                if len(text) > 0:
+                    self.console.echo(text)
+                    self.received.append(text)
+                    if self.logFile is not None:
+                        self.logFile.write(text)
+        except Exception, e:
+            # On any exception, just exit the thread
+            pass
 
     def close(self):
         self.telnet.close()
+        self.console.summarise()
+        if self.logFile is not None:
+            self.logFile.close()
 
     def waitFor(self, text, timeout):
         '''Waits for the specified text to be received.  Any text
-           in the receivedText variable is checked first.  Returns
+           already in the receive buffer is checked first.  Returns
            True if the text is found, False if not.'''
         timeRemaining = timeout
         items = []
@@ -868,24 +2240,38 @@ class TelnetConnection(object):
             items = text
         else:
             items.append(text)
+        # Each search continues from where the previous one stopped
+        offsets = [0] * len(items)
+        deadline = time.time() + timeout
         found = False
         while not found and timeRemaining > 0.0:
-            for item in items:
-                found = found or self.receivedText.find(item) >= 0
+            for i in range(len(items)):
+                if not found:
+                    position, offsets[i] = self.received.find(items[i], offsets[i])
+                    found = position >= 0
             if not found:
-                Sleep(0.1)
-                timeRemaining -= 0.1
-        #print "Looking for %s in %s" % (repr(text), repr(self.receivedText))
+                timeRemaining = deadline - time.time()
+                if timeRemaining > 0.0:
+                    self.received.arrival.wait(timeRemaining)
         return found
 
+    def waitForAny(self, patterns, timeout, offset=0):
+        '''Waits for any of the regular expressions, or a PatternMatcher,
+           to match text received since the buffer was last cleared, from
+           the offset onwards.  Returns a PatternMatch for the earliest
+           match or None if none is found within the timeout.'''
+        return self.received.waitFor(makePatternMatcher(patterns), timeout, offset)
+
     def write(self, text):
         self.telnet.write(text)
 
     def clearReceivedText(self):
-        self.receivedText = ''
+        self.received.clear()
 
     def getReceivedText(self):
-        return self.receivedText
+        return self.received.getText()
+
+    receivedText = property(getReceivedText)
 
 ################################################
 # Class that launches a command line in parallel and then provides
@@ -893,21 +2279,32 @@ class TelnetConnection(object):
 class AsynchronousProcess(object):
     '''Launch a process and provide communications.'''
     def __init__(self, runCmd, directory, logFile=None, name=''):
-        self.receivedTextStdout = ''
-        self.receivedTextStderr = ''
         self.processRunning = True
         self.logFile = None
         self.name = name
+        self.console = ConsoleEcho(name)
+        self.stdoutBuffer = self.createBuffer('stdout')
+        self.stderrBuffer = self.createBuffer('stderr')
         if logFile is not None:
             print "Opening process log file %s" % logFile
-            self.logFile = open(logFile, 'a+')
+            self.logFile = LogWriter(logFile)
         self.process = subprocess.Popen(runCmd, cwd=directory, bufsize=1, stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, preexec_fn=os.setsid)
         #self.rxThreadIdStdout = thread.start_new_thread(self.receiveThreadStdout, ())
         self.rxThreadIdStdout = Spawn(self.receiveThreadStdout)
         #self.rxThreadIdStderr = thread.start_new_thread(self.receiveThreadStderr, ())
         self.rxThreadIdStderr = Spawn(self.receiveThreadStderr)
 
+    def createBuffer(self, stream):
+        '''Returns the buffer for the text of one of the streams, spilling
+           to disc if a spill directory has been given.'''
+        if SpillBuffer.spillDirectory is None:
+            result = ReceiveBuffer(None)
+        else:
+            result = SpillBuffer(tempfile.mkdtemp(prefix='%s-%s-' % (self.name, stream),
+                dir=SpillBuffer.spillDirectory))
+        return result
+
     def receiveThreadStdout(self):
         try:
             flags = fcntl.fcntl(self.process.stdout, fcntl.F_GETFL)
@@ -915,16 +2312,7 @@ class AsynchronousProcess(object):
             while self.processRunning:
                 #if select.select([self.process.stdout], [], [])[0]:
                 if cothread.coselect.select([self.process.stdout], [], [])[0]:
-                    text = self.process.stdout.read()
-                    lines = text.split('\n')
-                    for line in lines:
-                        print '%s:o> %s' % (self.name, repr(line))
-                    sys.stdout.flush()
-                    self.receivedTextStdout += text
-                    if self.logFile is not None:
-                        self.logFile.write(text)
-                        self.logFile.flush()
-                        os.fsync(self.logFile.fileno())
+                    self.receivedStdout(self.process.stdout.read())
         except Exception, e:
             # On any exception, just exit the thread
             pass
@@ -937,54 +2325,75 @@ class AsynchronousProcess(object):
             while self.processRunning:
                 #if select.select([self.process.stderr], [], [])[0]:
                 if cothread.coselect.select([self.process.stderr], [], [])[0]:
-                    text = self.process.stderr.read()
-                    lines = text.split('\n')
-                    for line in lines:
-                        print '%s:o> %s' % (self.name, repr(line))
-                    sys.stdout.flush()
-                    self.receivedTextStderr += text
-                    if self.logFile is not None:
-                        self.logFile.write(text)
-                        self.logFile.flush()
-                        os.fsync(self.logFile.fileno())
+                    self.receivedStderr(self.process.stderr.read())
         except Exception, e:
             # On any exception, just exit the thread
             pass
 
+    def receivedStdout(self, text):
+        '''Handles text received from the process's stdout.'''
+        self.echo(text)
+        self.stdoutBuffer.append(text)
+        self.log(text)
+
+    def receivedStderr(self, text):
+        '''Handles text received from the process's stderr.'''
+        self.echo(text)
+        self.stderrBuffer.append(text)
+        self.log(text)
+
+    def echo(self, text):
+        self.console.echo(text)
+
+    def log(self, text):
+        if self.logFile is not None:
+            self.logFile.write(text)
+
     def kill(self):
         self.processRunning = False
-        killProcessAndChildren(self.process.pid)
+        killProcessAndChildren(self.process.pid, ownGroup=True)
+        self.console.summarise()
+        if self.logFile is not None:
+            self.logFile.close()
 
     def waitForStdout(self, text, timeout, discard):
-        '''Waits for the specified text to be received.  Any text
-           in the receivedText variable is checked first.  Returns
-           True if the text is found, False if not.'''
-        timeRemaining = timeout
-        found = re.search(text, self.receivedTextStdout)
-        while not found and timeRemaining > 0.0:
-            Sleep(1.0)
-            #time.sleep(1.0)
-            timeRemaining -= 1.0
-            found = re.search(text, self.receivedTextStdout)
-        #print "Found=%s, Looking for %s in %s" % (found, repr(text), repr(self.receivedTextStdout))
-        if discard and found:
-            self.receivedTextStdout = self.receivedTextStdout[found.end():]
+        '''Waits for the regular expression to match text received on
+           stdout since the read cursor.  Returns the match object, or None
+           if there is no match within the timeout.  If discard is set, the
+           read cursor moves past the match.'''
+        found = self.waitForMatch(self.stdoutBuffer, text, timeout, discard)
+        if found is not None:
+            found = found.match
         return found
 
     def waitForStderr(self, text, timeout, discard):
-        '''Waits for the specified text to be received.  Any text
-           in the receivedText variable is checked first.  Returns
-           True if the text is found, False if not.'''
-        timeRemaining = timeout
-        found = re.search(text, self.receivedTextStderr)
-        while not found and timeRemaining > 0.0:
-            Sleep(1.0)
-            #time.sleep(1.0)
-            timeRemaining -= 1.0
-            found = re.search(text, self.receivedTextStderr)
-        #print "Found=%s, Looking for %s in %s" % (found, repr(text), repr(self.receivedTextStderr))
-        if discard and found:
-            self.receivedTextStderr = self.receivedTextStderr[found.end():]
+        '''Waits for the regular expression to match text received on
+           stderr since the read cursor.  Returns the match object, or None
+           if there is no match within the timeout.  If discard is set, the
+           read cursor moves past the match.'''
+        found = self.waitForMatch(self.stderrBuffer, text, timeout, discard)
+        if found is not None:
+            found = found.match
+        return found
+
+    def waitForAnyStdout(self, patterns, timeout, discard):
+        '''Waits for any of the regular expressions, or a PatternMatcher,
+           to match the stdout text.  Returns a PatternMatch for the
+           earliest match or None if none is found within the timeout.'''
+        return self.waitForMatch(self.stdoutBuffer, patterns, timeout, discard)
+
+    def waitForAnyStderr(self, patterns, timeout, discard):
+        '''Waits for any of the regular expressions, or a PatternMatcher,
+           to match the stderr text.  Returns a PatternMatch for the
+           earliest match or None if none is found within the timeout.'''
+        return self.waitForMatch(self.stderrBuffer, patterns, timeout, discard)
+
+    def waitForMatch(self, buffer, patterns, timeout, discard):
+        '''Searches the buffer from its read cursor, resuming each search
+           a little before the end of the text searched as more arrives.'''
+        found = buffer.waitFor(makePatternMatcher(patterns), timeout)
+        if discard and found is not None:
+            buffer.discard(found.end)
         return found
 
     def write(self, text):
@@ -996,22 +2405,120 @@ class AsynchronousProcess(object):
             sys.stdout.flush()
 
     def clearReceivedTextStdout(self):
-        self.receivedTextStdout = ''
+        self.stdoutBuffer.clear()
 
     def getReceivedTextStdout(self):
-        return self.receivedTextStdout
+        return self.stdoutBuffer.getText()
 
     def clearReceivedTextStderr(self):
-        self.receivedTextStderr = ''
+        self.stderrBuffer.clear()
 
     def getReceivedTextStderr(self):
-        return self.receivedTextStderr
+        return self.stderrBuffer.getText()
+
+    receivedTextStdout = property(getReceivedTextStdout)
+    receivedTextStderr = property(getReceivedTextStderr)
+
+    def getPid(self):
+        return self.process.pid
 
     def sendSignal(self, signal):
         #p = subprocess.Popen("kill -%s %d" % (signal, self.process.pid), shell=True)
         #p.wait()
         self.process.send_signal(signal)
 
+################################################
+# Class that provides communication with a process kept running by
+# the RunTests entity pool.
+class AttachedProcess(AsynchronousProcess):
+    '''Attach to a pooled process through the files that capture its output
+    and the FIFO feeding its stdin.  Only output produced after attaching
+    is received from a reused instance.  Killing the object returns the process to the pool.'''
+    def __init__(self, pool, instance, logFile=None, name=''):
+        self.processRunning = True
+        self.logFile = None
+        self.name = name
+        self.console = ConsoleEcho(name)
+        self.stdoutBuffer = self.createBuffer('stdout')
+        self.stderrBuffer = self.createBuffer('stderr')
+        self.pool = pool
+        self.instanceId = instance['id']
+        self.pid = instance['pid']
+        if logFile is not None:
+            print "Opening process log file %s" % logFile
+            self.logFile = LogWriter(logFile)
+        self.stdinFile = open(instance['stdin'], 'w')
+        # Read the descriptors directly as stdio end of file is sticky.  A
+        # newly started instance is read from the beginning so that none
+        # of its start up output is missed.
+        stdoutFd = os.open(instance['stdout'], os.O_RDONLY)
+        stderrFd = os.open(instance['stderr'], os.O_RDONLY)
+        if instance['reused']:
+            os.lseek(stdoutFd, 0, os.SEEK_END)
+            os.lseek(stderrFd, 0, os.SEEK_END)
+        self.rxThreadIdStdout = Spawn(self.receiveThread, stdoutFd, self.receivedStdout)
+        self.rxThreadIdStderr = Spawn(self.receiveThread, stderrFd, self.receivedStderr)
+
+    def receiveThread(self, fd, handler):
+        # Regular files are always readable so poll them
+        while self.processRunning:
+            text = os.read(fd, 65536)
+            if len(text) > 0:
+                handler(text)
+            else:
+                Sleep(0.1)
+        os.close(fd)
+
+    def kill(self):
+        self.processRunning = False
+        self.stdinFile.close()
+        self.pool.release(self.instanceId)
+        self.console.summarise()
+        if self.logFile is not None:
+            self.logFile.close()
+
+    def write(self, text):
+        self.stdinFile.write(text)
+        self.stdinFile.flush()
+        print text
+        sys.stdout.flush()
+
+    def getPid(self):
+        return self.pid
+
+    def sendSignal(self, signal):
+        os.kill(self.pid, signal)
+
+################################################
+# Client of the RunTests entity pool
+class EntityPoolClient(object):
+    '''Requests running IOCs and simulations from the entity pool.'''
+    def __init__(self, socketName):
+        self.socket = socket.socket(socket.AF_UNIX)
+        self.socket.connect((socketName))
+        self.rFile = self.socket.makefile('r')
+
+    def request(self, **kargs):
+        self.socket.sendall(json.dumps(kargs) + '\n')
+        reply = json.loads(self.rFile.readline())
+        if 'error' in reply:
+            raise RuntimeError('Entity pool: %s' % reply['error'])
+        return reply
+
+    def acquire(self, kind, directory, command, fresh=False):
+        '''Returns a dictionary describing a running instance.  No
+        directory means the current one, as when a process is started
+        directly.  A fresh instance is started, rather than an idle one
+        reused, if fresh is set.'''
+        if directory is None:
+            directory = '.'
+        return self.request(op='acquire', kind=kind, directory=os.path.abspath(directory),
+            command=command, environment=dict(os.environ), fresh=fresh)
+
+    def release(self, id):
+        '''Returns the instance to the pool.'''
+        self.request(op='release', id=id)
+
 ################################################
 # Class that handles an IP power 9258 power switch
 class PowerSwitch(object):
@@ -1053,6 +2560,177 @@ class CrateMonitor(object):
         '''Send a reset command.'''
         self.telnet.write('R,7E\r')
 
+################################################
+# Classes that program the redirector a hardware IOC boots through
+class ConfigureIocBackend(object):
+    '''Reads and edits the redirector with the configure-ioc tool.'''
+    def show(self, name):
+        '''Returns the path the redirector holds for the IOC, or None.'''
+        text = subprocess.Popen(['configure-ioc', 'show', name],
+            stdout=subprocess.PIPE).communicate()[0]
+        for line in text.splitlines():
+            words = line.split()
+            if len(words) >= 2 and words[0] == name:
+                return words[1]
+        return None
+    def edit(self, name, path):
+        '''Asks for the redirector entry of the IOC to be changed.'''
+        subprocess.Popen(['configure-ioc', 'edit', name, path],
+            stdout=subprocess.PIPE).communicate()
+
+class LocalRedirectorBackend(object):
+    '''A stand in for the redirector that holds the paths in memory.  An
+    edit becomes visible after the delay, as the real redirector takes a
+    while to pick up a change.'''
+    def __init__(self, paths=None, delay=0.0):
+        self.paths = dict(paths or {})
+        self.delay = delay
+        self.pending = {}
+        self.shows = 0
+        self.edits = 0
+    def show(self, name):
+        self.shows += 1
+        if name in self.pending and time.time() >= self.pending[name][1]:
+            self.paths[name] = self.pending.pop(name)[0]
+        return self.paths.get(name)
+    def edit(self, name, path):
+        self.edits += 1
+        self.pending[name] = (path, time.time() + self.delay)
+
+class RedirectorClient(object):
+    '''Points the redirector entry of an IOC at a boot path, waiting for
+    the change to take effect.  The redirector is polled at intervals
+    that double from the initial interval up to the maximum.  The path
+    each IOC was last seen or set to is cached, shared by all clients,
+    so nothing is asked of the redirector when it already matches.'''
+    cache = {}
+
+    def __init__(self, backend=None, timeout=100.0, initialInterval=0.5, maxInterval=8.0):
+        self.backend = backend
+        if self.backend is None:
+            self.backend = ConfigureIocBackend()
+        self.timeout = timeout
+        self.initialInterval = initialInterval
+        self.maxInterval = maxInterval
+        self.timeTaken = None
+
+    def configure(self, name, path):
+        '''Makes the redirector entry of the IOC the path.  Returns True
+        if the redirector reports the path within the timeout.'''
+        startTime = time.time()
+        if RedirectorClient.cache.get(name) == path:
+            result = True
+            print 'Redirector for %s already set to %s' % (name, path)
+        else:
+            pathNow = self.backend.show(name)
+            if pathNow != path:
+                self.backend.edit(name, path)
+                interval = self.initialInterval
+                pathNow = self.backend.show(name)
+                while pathNow != path and time.time() - startTime < self.timeout:
+                    Sleep(min(interval, max(startTime + self.timeout - time.time(), 0)))
+                    interval = min(interval * 2, self.maxInterval)
+                    pathNow = self.backend.show(name)
+            result = pathNow == path
+            if result:
+                RedirectorClient.cache[name] = path
+            else:
+                RedirectorClient.cache.pop(name, None)
+            print 'Redirector for %s is %s after %.1fs' % (name, pathNow, time.time() - startTime)
+        self.timeTaken = time.time() - startTime
+        return result
+
+################################################
+# Classes that follow the boot of a hardware IOC on its console
+class BootStage(object):
+    '''A state of a boot sequence, entered as soon as any of the marker
+    regular expressions appears on the console.  Timeout is how long to
+    wait for it after the previous state was entered.  An optional stage
+    is one the boot may pass without its marker appearing.'''
+    def __init__(self, name, markers, timeout, optional=False):
+        self.name = name
+        self.markers = markers
+        self.timeout = timeout
+        self.optional = optional
+
+class BootSequence(object):
+    '''Tracks the state of a hardware IOC boot from the text received on
+    its telnet connection.  Each run moves through a list of stages,
+    searching on from where the previous state's marker was found.  An
+    optional stage is passed over if the marker of the stage after it
+    appears first, in which case the wait lasts for the timeout of the
+    first stage that is not optional.  The crash markers are looked for
+    throughout so that a crash ends the wait at once.  The time each
+    state took to reach is recorded.'''
+    def __init__(self, name, connection, crashMarkers=[]):
+        self.name = name
+        self.connection = connection
+        self.crashMarkers = crashMarkers
+        self.state = 'reset'
+        self.failed = False
+        self.crashed = False
+        self.crashText = None
+        self.offset = 0
+        self.stageTimes = []
+        self.stateTime = time.time()
+
+    def enter(self, state, failed=False):
+        '''Moves to the state, recording the time taken to reach it.  A
+        failed state ends the boot.'''
+        now = time.time()
+        self.state = state
+        self.failed = failed
+        self.stageTimes.append((state, now - self.stateTime))
+        self.stateTime = now
+        print '%s: %s after %.1fs' % (self.name, state, self.stageTimes[-1][1])
+
+    def skipReceived(self):
+        '''Ignores the text received so far.'''
+        self.offset = self.connection.received.end()
+
+    def settle(self, timeout):
+        '''Waits for up to the timeout for some text to be received, for
+        example the response to a command.'''
+        found = self.connection.waitForAny(r'\S', timeout, self.offset)
+        if found is not None:
+            self.offset = found.end
+
+    def run(self, stages):
+        '''Moves through the stages.  Returns True once the last is
+        entered, or False if the boot crashed or a stage timed out.'''
+        i = 0
+        while i < len(stages):
+            patterns = []
+            owners = []
+            j = i
+            going = True
+            while going and j < len(stages):
+                patterns += stages[j].markers
+                owners += [j] * len(stages[j].markers)
+                timeout = stages[j].timeout
+                going = stages[j].optional
+                j += 1
+            patterns += self.crashMarkers
+            found = self.connection.waitForAny(patterns, timeout, self.offset)
+            if found is None:
+                self.enter('timed out waiting for %s' % stages[j - 1].name, True)
+                return False
+            self.offset = found.end
+            if found.index >= len(owners):
+                self.crashed = True
+                self.crashText = found.match.group(0)
+                self.enter('crashed', True)
+                print '%s: crash detected, %s' % (self.name, repr(self.crashText))
+                return False
+            i = owners[found.index]
+            self.enter(stages[i].name)
+            i += 1
+        return True
+
+    def describe(self):
+        return '%s boot: %s' % (self.name, ', '.join(['%s %.1fs' % (state, timeTaken)
+            for state, timeTaken in self.stageTimes]))
+
 ################################################
 # Target definition class
 class Target(object):
@@ -1076,6 +2754,9 @@ class Target(object):
         self.suite = suite
         self.name = name
         self.entities = entities
+        self.timings = []
+        self.reportedTimings = 0
+        self.destroyed = False
         self.suite.addTarget(self)
         # Convert original API to new API
         if len(self.entities) == 0:
@@ -1106,26 +2787,139 @@ class Target(object):
                 self.entities.append(ParameterEntity(name, value))
 
     def __del__(self):
-        self.destroy()
+        # No cothreads are started during garbage collection
+        if not self.destroyed:
+            self.destroySynchronously()
 
     def prepare(self, doBuild, runIoc, runGui, diagnosticLevel, runSim, underHudson, suite):
         '''Prepares the target for execution of the test suite.'''
+        self.timings = []
+        self.reportedTimings = 0
+        self.destroyed = False
         if doBuild:
             for phase in range(numPhases):
-                for e in self.entities:
-                    e.build(phase)
+                self.concurrently(self.entities, 'build', phase)
         for phase in range(numPhases):
-            for e in self.entities:
-                e.run(phase, underHudson, runSim, runIoc, runGui, suite)
+            self.concurrently(self.entities, 'run', phase, underHudson, runSim, runIoc, runGui, suite)
         for phase in range(numPhases):
-            for e in self.entities:
-                e.prepare(phase, diagnosticLevel, suite)
+            self.concurrently(self.entities, 'prepare', phase, diagnosticLevel, suite)
 
     def destroy(self):
         '''Returns the target to it's initial state.'''
+        # Every entity gets the chance to clean up before any error is raised
+        self.destroyed = True
+        entities = list(self.entities)
+        entities.reverse()
+        error = None
+        for phase in range(numPhases):
+            try:
+                self.concurrently(entities, 'destroy', phase)
+            except Exception, e:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def destroySynchronously(self):
+        '''As destroy, but calls the entities one at a time in this
+        cothread.'''
+        self.destroyed = True
+        entities = list(self.entities)
+        entities.reverse()
+        error = None
         for phase in range(numPhases):
-            for e in self.entities:
-                e.destroy(phase)
+            for entity in entities:
+                try:
+                    entity.destroy(phase)
+                except Exception, e:
+                    if error is None:
+                        error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def concurrently(self, entities, method, *args):
+        '''Calls the named method of each of the entities, each in a cothread
+        of its own, started in list order, so entities working in the same
+        phase overlap their waits.  Returns once all have finished, raising
+        the first exception any of them raised.  The first argument is
+        the phase.  The time each call took, and the time for the phase
+        as a whole, are added to the timings.'''
+        phase = args[0]
+        def timed(entity):
+            startTime = time.time()
+            try:
+                getattr(entity, method)(*args)
+            finally:
+                self.timings.append((entity, method, phase, startTime, time.time()))
+        startTime = time.time()
+        tasks = [Spawn(timed, e, raise_on_wait=True) for e in entities]
+        error = None
+        for task in tasks:
+            try:
+                task.Wait()
+            except Exception, e:
+                if error is None:
+                    error = sys.exc_info()
+        self.timings.append((None, method, phase, startTime, time.time()))
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    timingThreshold = 0.05
+
+    def entityLabel(self, entity):
+        '''Returns the name of the entity for timing reports.  Entities
+        created by the original API are all named #.'''
+        if entity.name == '#':
+            return entity.__class__.__name__
+        return entity.name
+
+    def timingReport(self):
+        '''Returns the lines of a table of the timings not yet reported,
+        one line for each method and phase, giving the phase time and the
+        time of each entity call in it, and the same as a list of name,
+        value pairs for the XML results.  Calls are listed in the order
+        they started.  Anything quicker than the timing threshold is left
+        out.'''
+        lines = []
+        properties = []
+        timings = sorted(self.timings[self.reportedTimings:], key=lambda t: t[3])
+        for entity, method, phase, startTime, stopTime in timings:
+            if entity is None and stopTime - startTime >= self.timingThreshold:
+                calls = []
+                properties.append(('timing.%s.%s' % (method, phase),
+                    '%.3f' % (stopTime - startTime)))
+                for e, m, p, start, stop in timings:
+                    if e is not None and m == method and p == phase and \
+                            stop - start >= self.timingThreshold:
+                        calls.append('%s %.2fs' % (self.entityLabel(e), stop - start))
+                        properties.append(('timing.%s.%s.%s' % (method, phase,
+                            self.entityLabel(e)), '%.3f' % (stop - start)))
+                lines.append('%-8s phase %s %7.2fs  %s' % (method, phase,
+                    stopTime - startTime, ', '.join(calls)))
+        return lines, properties
+
+    def traceEvents(self):
+        '''Returns the timings as Chrome trace events.  The target is a
+        process, each entity a thread and the phases are on thread 0.'''
+        pid = self.suite.targets.index(self)
+        result = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+            'args': {'name': self.name}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+            'args': {'name': 'phases'}}]
+        for i in range(len(self.entities)):
+            result.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': i + 1,
+                'args': {'name': self.entityLabel(self.entities[i])}})
+        for entity, method, phase, startTime, stopTime in self.timings:
+            if entity is None:
+                name = '%s phase %s' % (method, phase)
+                tid = 0
+            else:
+                name = '%s %s' % (method, self.entityLabel(entity))
+                tid = self.entities.index(entity) + 1
+            result.append({'name': name, 'cat': method, 'ph': 'X', 'pid': pid,
+                'tid': tid, 'ts': int(startTime * 1e6),
+                'dur': int((stopTime - startTime) * 1e6), 'args': {'phase': phase}})
+        return result
 
     def reportCoverage(self):
         '''Returns the coverage reports.'''
@@ -1134,6 +2928,24 @@ class Target(object):
             result += e.reportCoverage()
         return result
 
+    def buildReport(self):
+        '''Returns a line describing each entity build.'''
+        result = []
+        for e in self.entities:
+            if e.buildRunner is not None:
+                result.append(e.buildRunner.describe())
+        return result
+
+    def processIds(self):
+        '''Returns a list of the entity name, process id pairs of the
+        running processes owned by the entities.'''
+        result = []
+        for e in self.entities:
+            pid = e.processId()
+            if pid is not None:
+                result.append((e.name, pid))
+        return result
+
     def getEntity(self, name):
         '''Returns the first entity with the given name'''
         result = None
@@ -1192,6 +3004,283 @@ class SimDevice(object):
         self.suite = None
         self.pythonShell = pythonShell
 
+################################################
+# Readiness probes, that decide when a newly started entity can be used
+class ReadinessProbe(object):
+    '''The base class for readiness probes.  Polls ready() every interval
+    until it returns True or the timeout expires; derived classes override
+    ready() or wait().'''
+
+    def __init__(self, timeout=60.0, interval=0.1):
+        self.timeout = timeout
+        self.interval = interval
+
+    def ready(self, entity):
+        return True
+
+    def wait(self, entity):
+        '''Returns True if the entity became ready within the timeout.'''
+        deadline = time.time() + self.timeout
+        result = self.ready(entity)
+        while not result and time.time() < deadline:
+            Sleep(self.interval)
+            result = self.ready(entity)
+        return result
+
+    def describe(self):
+        return self.__class__.__name__
+
+class DelayProbe(ReadinessProbe):
+    '''Waits for a fixed time.'''
+
+    def __init__(self, delay=10.0):
+        ReadinessProbe.__init__(self, delay)
+
+    def wait(self, entity):
+        Sleep(self.timeout)
+        return True
+
+    def describe(self):
+        return 'fixed delay of %ss' % self.timeout
+
+class StdoutProbe(ReadinessProbe):
+    '''Ready when the pattern appears on the stdout or stderr of the
+    entity's process, by default the banner printed by iocInit, which
+    goes to stderr through errlogPrintf on later EPICS releases.  Gives
+    up as soon as the process exits.'''
+
+    def __init__(self, pattern=r'ioc(Init|Run): All initiali[sz]ation complete', timeout=60.0):
+        ReadinessProbe.__init__(self, timeout)
+        self.pattern = pattern
+
+    def wait(self, entity):
+        matcher = makePatternMatcher(self.pattern)
+        buffers = [entity.process.stdoutBuffer, entity.process.stderrBuffer]
+        offsets = [0] * len(buffers)
+        deadline = time.time() + self.timeout
+        while True:
+            alive = processAlive(entity.process.getPid())
+            for i in range(len(buffers)):
+                found, offsets[i] = buffers[i].search(matcher, offsets[i])
+                if found is not None:
+                    return True
+            timeRemaining = deadline - time.time()
+            if not alive or timeRemaining <= 0.0:
+                return False
+            # Woken by stdout at once, stderr is checked every interval
+            buffers[0].arrival.wait(min(timeRemaining, self.interval))
+
+    def describe(self):
+        return 'output matched %s' % repr(self.pattern)
+
+class PvProbe(ReadinessProbe):
+    '''Ready when the PV connects.'''
+
+    def __init__(self, pv, timeout=60.0):
+        ReadinessProbe.__init__(self, timeout)
+        self.pv = pv
+
+    def wait(self, entity):
+        return connect(self.pv, timeout=self.timeout, throw=False).ok
+
+    def describe(self):
+        return 'PV %s connected' % self.pv
+
+class PortProbe(ReadinessProbe):
+    '''Ready when the TCP port accepts a connection.'''
+
+    def __init__(self, port, host='localhost', timeout=60.0, interval=0.2):
+        ReadinessProbe.__init__(self, timeout, interval)
+        self.port = port
+        self.host = host
+
+    def ready(self, entity):
+        # Connect without blocking the other cothreads
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(0)
+        try:
+            status = s.connect_ex((self.host, int(self.port)))
+            if status in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                cothread.coselect.select([], [s], [], 1.0)
+                status = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            result = status == 0
+        except socket.error:
+            result = False
+        s.close()
+        return result
+
+    def describe(self):
+        return 'port %s:%s accepted' % (self.host, self.port)
+
+class WindowProbe(ReadinessProbe):
+    '''Ready when a window whose name contains the title is shown on the
+    X display.'''
+
+    def __init__(self, title, timeout=60.0, interval=0.5):
+        ReadinessProbe.__init__(self, timeout, interval)
+        self.title = title
+
+    def ready(self, entity):
+        # Read the window tree without blocking the other cothreads
+        devNull = open(os.devnull, 'w')
+        try:
+            p = subprocess.Popen(['xwininfo', '-root', '-tree'],
+                stdout=subprocess.PIPE, stderr=devNull)
+        except OSError:
+            return False
+        finally:
+            devNull.close()
+        chunks = []
+        going = True
+        while going:
+            cothread.coselect.select([p.stdout], [], [])
+            chunk = os.read(p.stdout.fileno(), 65536)
+            chunks.append(chunk)
+            going = len(chunk) > 0
+        p.stdout.close()
+        while p.poll() is None:
+            Sleep(0.01)
+        return self.title in ''.join(chunks)
+
+    def describe(self):
+        return 'window %s shown' % repr(self.title)
+
+################################################
+# Class that runs the build of an entity
+class BuildRunner(object):
+    '''Runs a build command in a directory, recording the outcome and the
+    time taken.  At most jobs builds run at once.  In incremental mode,
+    after each successful build a digest of the command and of the
+    directory's files, which include configure/RELEASE, is stored in the
+    directory's digestFile, with the build product directories present.
+    The build is skipped while the digest still matches and those
+    directories still hold something.  Build products, at any depth, and
+    the output of test runs are left out of the digest.'''
+    incremental = False
+    jobs = 1
+    running = 0
+    digestFile = '.autotestbuild'
+    buildProducts = ['bin', 'lib', 'include', 'db', 'dbd', 'html', 'templates', 'javalib']
+    testDirectories = [os.path.join('etc', 'test'), os.path.join('dls', 'test')]
+    testOutputs = ['.log', '.xml', '.deps', '.trace.json']
+
+    def __init__(self, name, directory, command):
+        self.name = name
+        self.directory = directory
+        if self.directory is None:
+            self.directory = '.'
+        self.command = command
+        self.outcome = None
+        self.timeTaken = None
+
+    def run(self):
+        '''Runs the build unless it is up to date.  Returns True unless
+        the build failed.'''
+        startTime = time.time()
+        if BuildRunner.incremental and self.upToDate():
+            print 'Build of %s is up to date' % self.name
+            self.outcome = 'up to date'
+        else:
+            # Wait for a share of the job budget
+            while BuildRunner.running >= BuildRunner.jobs:
+                Sleep(0.2)
+            BuildRunner.running += 1
+            try:
+                p = subprocess.Popen(self.command, cwd=self.directory, shell=True)
+                while p.poll() is None:
+                    Sleep(0.2)
+            finally:
+                BuildRunner.running -= 1
+            if p.returncode == 0:
+                self.outcome = 'built'
+                if BuildRunner.incremental:
+                    self.storeDigest(*self.digest())
+            else:
+                self.outcome = 'failed with status %s' % p.returncode
+        self.timeTaken = time.time() - startTime
+        return not self.outcome.startswith('failed')
+
+    def upToDate(self):
+        '''Returns True if the stored digest matches and the build products
+        it was stored with are still there.'''
+        stored = self.readDigests().get(self.command)
+        result = isinstance(stored, dict) and stored.get('digest') == self.digest()[0]
+        if result:
+            for product in stored.get('products', []):
+                path = os.path.join(self.directory, product)
+                if not os.path.isdir(path) or len(os.listdir(path)) == 0:
+                    result = False
+        return result
+
+    def isTestOutput(self, path):
+        '''Returns True for the files written by running the suites.'''
+        return os.path.dirname(path) in BuildRunner.testDirectories and \
+            len([s for s in BuildRunner.testOutputs if path.endswith(s)]) > 0
+
+    def digest(self):
+        '''Returns a digest of the command and of the names and contents
+        of the files in the directory tree, less build products, test
+        output, hidden files and compiled Python, and the relative paths
+        of the build product directories that hold something.  Products
+        are only installed at the top of the tree, so directories deeper
+        down with the same names, such as src/include, are sources.'''
+        result = hashlib.sha1(self.command)
+        products = []
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                for d in dirs:
+                    if d in BuildRunner.buildProducts and len(os.listdir(os.path.join(root, d))) > 0:
+                        products.append(d)
+                dirs[:] = [d for d in dirs if d not in BuildRunner.buildProducts]
+            dirs[:] = sorted([d for d in dirs if not d.startswith('.') and
+                not d.startswith('O.')])
+            for f in sorted(files):
+                path = os.path.join(root, f)
+                relPath = os.path.relpath(path, self.directory)
+                if not f.startswith('.') and not f.endswith('.pyc') and \
+                        os.path.isfile(path) and not self.isTestOutput(relPath):
+                    result.update(relPath + '\0')
+                    try:
+                        file = open(path, 'rb')
+                        try:
+                            block = file.read(65536)
+                            while len(block) > 0:
+                                result.update(block)
+                                block = file.read(65536)
+                        finally:
+                            file.close()
+                    except IOError:
+                        # Unreadable files and the like
+                        pass
+        return (result.hexdigest(), sorted(products))
+
+    def readDigests(self):
+        '''Returns the stored digests, keyed by build command.'''
+        result = {}
+        try:
+            result = json.load(open(os.path.join(self.directory, BuildRunner.digestFile)))
+        except (IOError, ValueError):
+            pass
+        return result
+
+    def storeDigest(self, digest, products):
+        '''Adds the digest and products to those stored, re-reading the
+        file as other commands may have built in the same directory
+        meanwhile.'''
+        digests = self.readDigests()
+        digests[self.command] = {'digest': digest, 'products': products}
+        fileName = os.path.join(self.directory, BuildRunner.digestFile)
+        try:
+            wFile = open(fileName + '.tmp', 'w')
+            json.dump(digests, wFile)
+            wFile.close()
+            os.rename(fileName + '.tmp', fileName)
+        except (IOError, OSError), e:
+            print 'Failed to store build digest in %s: %s' % (fileName, e)
+
+    def describe(self):
+        return 'Build %s: %s in %.1fs' % (self.name, self.outcome, self.timeTaken)
+
 ################################################
 # Entity base class
 class Entity(object):
@@ -1199,6 +3288,29 @@ class Entity(object):
 
     def __init__(self, name):
         self.name = name
+        self.readyTime = None
+        self.buildRunner = None
+
+    def rebuilt(self):
+        '''Returns True if the entity was built by this run.'''
+        return self.buildRunner is not None and self.buildRunner.outcome == 'built'
+
+    def waitUntilReady(self, probe, suite):
+        '''Waits for the probe to find the entity ready, recording and
+        reporting the time taken.  Returns False if it timed out, in which
+        case the suite carries on anyway.'''
+        startTime = time.time()
+        result = probe.wait(self)
+        self.readyTime = time.time() - startTime
+        if result:
+            text = '%s ready in %.1fs, %s' % (self.name, self.readyTime, probe.describe())
+        else:
+            text = '%s not ready after %.1fs, waiting for %s' % (self.name,
+                self.readyTime, probe.describe())
+        print text
+        if suite is not None:
+            suite.diagnostic(text, 1)
+        return result
 
     def build(self, phase):
         pass
@@ -1218,6 +3330,14 @@ class Entity(object):
     def rpcObject(self):
         return None
 
+    def dependencies(self):
+        '''Returns the files and directories the entity depends on.'''
+        return []
+
+    def processId(self):
+        '''Returns the id of the entity's running process, if any.'''
+        return None
+
 ################################################
 # IOC Entity definition class
 class IocEntity(Entity):
@@ -1238,7 +3358,10 @@ class IocEntity(Entity):
             crateMonitorPort=None,
             powerControlAddress=None,
             powerControlChan=None,
-            automaticRun=True):
+            automaticRun=True,
+            resetCmds=[],
+            readiness=None,
+            redirector=None):
         Entity.__init__(self, name)
         self.buildCmd = buildCmd
         self.buildPhase = buildPhase
@@ -1251,6 +3374,15 @@ class IocEntity(Entity):
         self.telnetPort = telnetPort
         self.telnetLogFile = telnetLogFile
         self.automaticRun = automaticRun
+        self.resetCmds = resetCmds
+        self.readiness = readiness
+        if self.readiness is None:
+            self.readiness = StdoutProbe()
+        self.redirector = redirector
+        if self.redirector is None:
+            self.redirector = RedirectorClient()
+        self.suite = None
+        self.reused = False
         self.telnetConnection = None
         self.crateMonitor = None
         self.powerSwitch = None
@@ -1259,18 +3391,62 @@ class IocEntity(Entity):
         if powerControlAddress is not None and powerControlChan is not None:
             self.powerSwitch = PowerSwitch(powerControlAddress, powerControlChan)
         self.process = None
+        self.bootSequence = None
+
+    # The boot of a vxWorks IOC
+    vxWorksBootStages = [
+        BootStage('autoboot prompt', [re.escape('Press any key to stop auto-boot')], 60),
+        BootStage('loading', [r'Loading\.\.\.', r'Starting at 0x'], 60, optional=True),
+        BootStage('script done', [re.escape('Done executing startup script')], 120)]
+    vxWorksCrashMarkers = [r'Exception (current|next) instruction address',
+        r"Can't load boot file", r'Error loading file']
+    # Where an RTEMS IOC loads its boot file from
+    rtemsPrompt = re.escape('MVME5500>')
+    rtemsCrashMarkers = [re.escape('unrecoverable exception!!!')]
+    rtemsBootFiles = './base/bin/RTEMS-mvme5500/rtemsTestHarness*'
+    tftpServer = '172.23.240.2'
+    tftpDirectory = '/tftpboot/rtems'
+    tftpGetCmd = 'tftpGet -c172.23.248.38 -s%(server)s -g172.23.240.254 -m255.255.240.0 -frtems/%(file)s'
+
+    def uploadBootFiles(self, files):
+        '''Copies the files to the TFTP server, letting the other cothreads
+        run meanwhile.  Returns True for success.'''
+        p = subprocess.Popen(['scp'] + files + ['%s:%s/' % (self.tftpServer, self.tftpDirectory)])
+        while p.poll() is None:
+            Sleep(0.2)
+        return p.returncode == 0
+
+    def resetHardware(self, rebootCmd):
+        '''Resets a hardware IOC through its power switch or crate
+        monitor, or failing those by its own shell.'''
+        print 'Resetting IOC'
+        if self.powerSwitch is not None:
+            self.powerSwitch.reset()
+        elif self.crateMonitor is not None:
+            self.crateMonitor.reset()
+        else:
+            # Get a fresh prompt before rebooting
+            self.telnetConnection.write('\r')
+            self.bootSequence.settle(1.0)
+            self.telnetConnection.write(rebootCmd)
+        # Markers seen before the reset are stale
+        self.bootSequence.skipReceived()
 
     def build(self, buildPhase):
         if self.buildCmd is not None and buildPhase == self.buildPhase:
-            p = subprocess.Popen(self.buildCmd, cwd=self.directory, shell=True)
-            p.wait()
+            self.buildRunner = BuildRunner(self.name, self.directory, self.buildCmd)
+            self.buildRunner.run()
 
     def run(self, phase, underHudson, runSim, runIoc, runGui, suite):
         self.underHudson = underHudson
+        self.suite = suite
         if phase == phaseNormal and runIoc and self.automaticRun:
             self.start()
-            if not self.vxWorks and not self.rtems:
-                Sleep(10)
+            if self.bootSequence is not None and self.bootSequence.failed:
+                # Do not run the cases against a dead IOC
+                raise RuntimeError(self.bootSequence.describe())
+            if not self.vxWorks and not self.rtems and not self.reused:
+                self.waitUntilReady(self.readiness, suite)
 
     def start(self, noStartupScriptWait=False):
         if self.vxWorks:
@@ -1278,52 +3454,44 @@ class IocEntity(Entity):
             self.prepareRedirector()
             self.telnetConnection = TelnetConnection(self.telnetAddress,
                     self.telnetPort, self.telnetLogFile)
-            print 'Resetting IOC'
-            if self.powerSwitch is not None:
-                self.powerSwitch.reset()
-            elif self.crateMonitor is not None:
-                self.crateMonitor.reset()
-            else:
-                Sleep(1)
-                self.telnetConnection.write('\r')
-                Sleep(1)
-                self.telnetConnection.write('reboot')
-            print 'Waiting for auto-boot message'
-            ok = self.telnetConnection.waitFor('Press any key to stop auto-boot', 60)
-            print "    ok=%s" % ok
-            if not noStartupScriptWait:
-                print 'Waiting for script loaded message'
-                ok = self.telnetConnection.waitFor('Done executing startup script', 120)
-                print "    ok=%s" % ok
+            self.bootSequence = BootSequence(self.name, self.telnetConnection,
+                self.vxWorksCrashMarkers)
+            self.resetHardware('reboot\r')
+            stages = self.vxWorksBootStages
+            if noStartupScriptWait:
+                stages = stages[:1]
+            self.bootSequence.run(stages)
         elif self.rtems:
             # Connect up the telnet
             self.telnetConnection = TelnetConnection(self.telnetAddress,
                     self.telnetPort, self.telnetLogFile)
-            # Reset the IOC
-            print 'Resetting IOC'
-            if self.powerSwitch is not None:
-                self.powerSwitch.reset()
-            elif self.crateMonitor is not None:
-                self.crateMonitor.reset()
-            else:
-                Sleep(1)
-                self.telnetConnection.write('\r')
-                Sleep(1)
-                self.telnetConnection.write('reset\r')
-            print 'Waiting for boot message'
-            ok = self.telnetConnection.waitFor('MVME5500>', 60)
-            print "    ok=%s" % ok
-            # Place the boot file in the TFTP directory
-            os.system('scp ./base/bin/RTEMS-mvme5500/rtemsTestHarness* 172.23.240.2:/tftpboot/rtems/.')
-            # Load the boot file
-            self.telnetConnection.write('tftpGet -c172.23.248.38 -s172.23.240.2 -g172.23.240.254 -m255.255.240.0 -frtems/%s\r' % self.bootCmd)
-            ok = self.telnetConnection.waitFor('MVME5500>', 60)
-            Sleep(1)
-            # Run the tests
-            #self.telnetConnection.write('netShut\r')
-            ok = self.telnetConnection.waitFor('MVME5500>', 60)
-            Sleep(1)
-            self.telnetConnection.write('go\r')
+            self.bootSequence = BootSequence(self.name, self.telnetConnection,
+                self.rtemsCrashMarkers)
+            self.resetHardware('reset\r')
+            if self.bootSequence.run([BootStage('monitor prompt', [self.rtemsPrompt], 60)]):
+                # Place the boot file in the TFTP directory
+                files = glob.glob(self.rtemsBootFiles)
+                if len(files) == 0:
+                    self.bootSequence.enter('no boot file matching %s' % self.rtemsBootFiles, True)
+                elif not self.uploadBootFiles(files):
+                    self.bootSequence.enter('boot file upload failed', True)
+                else:
+                    # Load the boot file and run it
+                    self.bootSequence.skipReceived()
+                    self.telnetConnection.write(self.tftpGetCmd % {'server': self.tftpServer,
+                        'file': self.bootCmd} + '\r')
+                    if self.bootSequence.run([BootStage('loaded', [self.rtemsPrompt], 60)]):
+                        self.telnetConnection.write('go\r')
+                        self.bootSequence.enter('started')
+        elif self.suite is not None and self.suite.entityPool is not None:
+            # Linux soft IOC kept running by the entity pool
+            # An instance started before a rebuild would run the old binary
+            instance = self.suite.entityPool.acquire('ioc', self.directory, self.bootCmd,
+                self.rebuilt())
+            self.process = AttachedProcess(self.suite.entityPool, instance, name=self.name)
+            self.reused = instance['reused']
+            if self.reused:
+                self.reset()
         else:
             self.process = AsynchronousProcess(self.bootCmd, self.directory, name=self.name)
             # Linux soft IOC
@@ -1348,40 +3516,35 @@ class IocEntity(Entity):
             self.process.kill()
             self.process = None
 
+    def reset(self):
+        '''Returns a reused IOC to its initial state before a new suite
+        uses it.  By default the resetCmds are written to the IOC shell,
+        derived classes may do more.'''
+        for cmd in self.resetCmds:
+            self.process.write('%s\n' % cmd)
+
     def prepareRedirector(self):
         '''Programs the redirector to load the IOC executable.'''
         # The path of the executable
         iocPath = os.path.normpath(os.path.join(os.getcwd(), self.directory, self.bootCmd))
-        print '@A:%s' % repr(iocPath)
-        # Is the redirector already correct?
-        str = subprocess.Popen('configure-ioc show %s' % self.name,
-            shell=True, stdout=subprocess.PIPE).communicate()[0]
-        pathNow = str.strip().split()[1]
-        print '@1:%s' % repr(pathNow)
-        if pathNow != iocPath:
-            # No, so set it
-            str = subprocess.Popen('configure-ioc edit %s %s' % (self.name, iocPath),
-                shell=True, stdout=subprocess.PIPE).communicate()[0]
-            print '@2:%s' % repr(str)
-            # Wait for the redirector to report the correct path
-            str = subprocess.Popen('configure-ioc show %s' % self.name,
-                shell=True, stdout=subprocess.PIPE).communicate()[0]
-            pathNow = str.strip().split()[1]
-            print '@3:%s' % repr(pathNow)
-            timeout = 100
-            while pathNow != iocPath and timeout > 0:
-                Sleep(2)
-                timeout -= 2
-                str = subprocess.Popen('configure-ioc show %s' % self.name,
-                    shell=True, stdout=subprocess.PIPE).communicate()[0]
-                pathNow = str.strip().split()[1]
-                print '@4:%s' % repr(pathNow)
-        return pathNow == iocPath
+        return self.redirector.configure(self.name, iocPath)
 
     def sendSignal(self, signal):
         if self.process is not None:
             self.process.sendSignal(signal)
 
+    def dependencies(self):
+        result = []
+        if self.directory is not None:
+            result.append(self.directory)
+        return result
+
+    def processId(self):
+        result = None
+        if self.process is not None:
+            result = self.process.getPid()
+        return result
+
     def verifyStdout(self, text, wait=0, discard=True):
         return self.process.waitForStdout(text, wait, discard)
 
@@ -1438,6 +3601,15 @@ class EpicsDbEntity(Entity):
             # Initialise the coverage tracking
             self.database.clearCoverage()
 
+    def dependencies(self):
+        result = []
+        if self.fileName is not None:
+            if self.directory is None:
+                result.append(self.fileName)
+            else:
+                result.append(os.path.join(self.directory, self.fileName))
+        return result
+
     def reportCoverage(self):
         result = ""
         report = self.database.coverageReport()
@@ -1463,8 +3635,15 @@ class BuildEntity(Entity):
 
     def build(self, buildPhase):
         if self.buildCmd is not None and buildPhase == self.buildPhase:
-            p = subprocess.Popen(self.buildCmd, cwd=self.directory, shell=True)
-            p.wait()
+            self.buildRunner = BuildRunner(self.name, self.directory, self.buildCmd)
+            self.buildRunner.run()
+
+    def dependencies(self):
+        '''The module's sources, that is the whole directory.'''
+        result = []
+        if self.directory is not None:
+            result.append(self.directory)
+        return result
 # For backwards compatibility, define an alias for BuildEntity
 class ModuleEntity(BuildEntity):
     pass
@@ -1479,7 +3658,9 @@ class SimulationEntity(Entity):
             diagPort=None,
             runCmd=None,
             pythonShell=True,
-            directory='.'):
+            directory='.',
+            resetCmd=None,
+            readiness=None):
         Entity.__init__(self, name)
         self.rpcPort = rpcPort
         self.diagPort = diagPort
@@ -1492,12 +3673,33 @@ class SimulationEntity(Entity):
         self.diagSimulation = None
         self.suite = None
         self.response = []
+        self.resetCmd = resetCmd
+        self.readiness = readiness
+        if self.readiness is None:
+            if self.rpcPort is not None:
+                self.readiness = PortProbe(self.rpcPort)
+            elif self.diagPort is not None:
+                self.readiness = PortProbe(self.diagPort)
+            else:
+                self.readiness = DelayProbe(10)
+        self.poolId = None
+        self.poolPid = None
+        self.reused = False
 
     def run(self, phase, underHudson, runSim, runIoc, runGui, suite):
+        self.suite = suite
         if phase == phaseEarly:
-            if runSim and self.runCmd is not None:
-                self.process = subprocess.Popen(self.runCmd, cwd=self.directory, shell=True)
-                Sleep(10)
+            if runSim and self.runCmd is not None and suite.entityPool is not None:
+                instance = suite.entityPool.acquire('simulation', self.directory, self.runCmd)
+                self.poolId = instance['id']
+                self.poolPid = instance['pid']
+                self.reused = instance['reused']
+                if not self.reused:
+                    self.waitUntilReady(self.readiness, suite)
+            elif runSim and self.runCmd is not None:
+                self.process = subprocess.Popen(self.runCmd, cwd=self.directory, shell=True,
+                    preexec_fn=os.setsid)
+                self.waitUntilReady(self.readiness, suite)
 
     def destroy(self, phase):
         if self.rpcSimulation is not None and phase == phaseEarly:
@@ -1507,12 +3709,47 @@ class SimulationEntity(Entity):
             self.diagSimulation.close()
             self.diagSimulation = None
         if self.process is not None and phase == phaseLate:
-            killProcessAndChildren(self.process.pid)
+            killProcessAndChildren(self.process.pid, ownGroup=True)
             self.process = None
+        if self.poolId is not None and phase == phaseLate:
+            self.suite.entityPool.release(self.poolId)
+            self.poolId = None
 
     def rpcObject(self):
         return self.rpcSimulation
 
+    def processId(self):
+        result = None
+        if self.process is not None:
+            result = self.process.pid
+        elif self.poolId is not None:
+            result = self.poolPid
+        return result
+
+    def reset(self):
+        '''Returns a reused simulation to its initial state before a new
+        suite uses it.  Calls reset() on the RPC simulation object if it
+        has one, otherwise sends the resetCmd through the diagnostic port.'''
+        if self.rpcSimulation is not None:
+            if hasattr(self.rpcSimulation, 'reset'):
+                self.rpcSimulation.reset()
+        elif self.resetCmd is not None:
+            self.command(self.resetCmd)
+
+    def dependencies(self):
+        '''The files named in the run command.'''
+        result = []
+        if self.runCmd is not None:
+            try:
+                words = shlex.split(self.runCmd)
+            except ValueError:
+                words = self.runCmd.split()
+            for word in words:
+                path = os.path.join(self.directory, word)
+                if os.path.isfile(path):
+                    result.append(path)
+        return result
+
     def reportCoverage(self):
         result = ""
         branches = None
@@ -1552,6 +3789,8 @@ class SimulationEntity(Entity):
                     import rpyc
                     self.rpcConnection = rpyc.classic.connect("localhost", port=self.rpcPort)
                     self.rpcSimulation = self.rpcConnection.root.simulation()
+                    if self.reused:
+                        self.reset()
                     # Initialise the coverage tracking
                     self.rpcSimulation.clearCoverage()
                     # Initialise the diagnostic level
@@ -1566,6 +3805,8 @@ class SimulationEntity(Entity):
                     self.diagSimulation.settimeout(0.1)
                     self.response = []
                     self.swallowInput()
+                    if self.reused:
+                        self.reset()
                     # Initialise the coverage tracking
                     self.command("covclear")
                     # Initialise the diagnostic level
@@ -1641,20 +3882,25 @@ class GuiEntity(Entity):
 
     def __init__(self, name,
             runCmd=None,
-            directory='.'):
+            directory='.',
+            readiness=None):
         Entity.__init__(self, name)
         self.runCmd = runCmd
         self.directory = directory
         self.process = None
+        self.readiness = readiness
+        if self.readiness is None:
+            self.readiness = DelayProbe(10)
 
     def run(self, phase, underHudson, runSim, runIoc, runGui, suite):
         if self.runCmd is not None and runGui and phase == phaseLate:
-            self.process = subprocess.Popen(self.runCmd, cwd=self.directory, shell=True)
-            Sleep(10)
+            self.process = subprocess.Popen(self.runCmd, cwd=self.directory, shell=True,
+                preexec_fn=os.setsid)
+            self.waitUntilReady(self.readiness, suite)
 
     def destroy(self, phase):
         if self.process is not None and phase == phaseNormal:
-            killProcessAndChildren(self.process.pid)
+            killProcessAndChildren(self.process.pid, ownGroup=True)
             self.process = None
 
 ################################################
@@ -0,0 +1,148 @@
+#!/bin/env dls-python
+
+# do imports
+import getopt, sys, os, time, tempfile, shutil
+from autotestframework import LogWriter, AsynchronousProcess
+
+helpText = '''
+  Measures the throughput of parts of the test framework that handle
+  IOC and simulation console output.
+
+  Syntax:
+    dls-benchmark.py [<options>]
+        where <options> is one or more of:
+        -h, --help                Print the help text and exit
+        --log                     Console log writing under each sync policy
+        --match                   Waiting for text from an IOC that prints
+                                  a lot of output
+        --dir=<directory>         Where to write the log files, eg. an NFS
+                                  mounted workspace, default a temporary
+                                  directory
+        --size=<megabytes>        Amount of output to generate, default 16
+        --chunk=<bytes>           Size of each piece of output, default 80
+'''
+
+class Benchmark(object):
+    def __init__(self):
+        self.benchmarks = []
+        self.directory = None
+        self.size = 16
+        self.chunkSize = 80
+
+    def processArguments(self):
+        '''Process the command line arguments.  Returns False
+           if the program is to proceed.'''
+        result = True
+        try:
+            opts, args = getopt.getopt(sys.argv[1:], 'h',
+                ['help', 'log', 'match', 'dir=', 'size=', 'chunk='])
+        except getopt.GetoptError, err:
+            print str(err)
+            return True
+        for o, a in opts:
+            if o in ('-h', '--help'):
+                print helpText
+                return True
+            elif o in ('--log'):
+                self.benchmarks.append(self.logBenchmark)
+            elif o in ('--match'):
+                self.benchmarks.append(self.matchBenchmark)
+            elif o in ('--dir'):
+                self.directory = a
+            elif o in ('--size'):
+                self.size = int(a)
+            elif o in ('--chunk'):
+                self.chunkSize = int(a)
+        if len(self.benchmarks) == 0:
+            print helpText
+        else:
+            result = False
+        return result
+
+    def do(self):
+        if not self.processArguments():
+            for benchmark in self.benchmarks:
+                benchmark()
+
+    def makeOutput(self):
+        '''Returns a list of lines of console output totalling the
+           requested size.'''
+        line = ('x' * (self.chunkSize - 1)) + '\n'
+        return [line] * (self.size * 1024 * 1024 / self.chunkSize)
+
+    def rate(self, numBytes, timeTaken):
+        return '%8.2f MB/s' % (numBytes / 1048576.0 / max(timeTaken, 1e-6))
+
+    def logBenchmark(self):
+        '''Writes the output through a LogWriter under each sync policy,
+           reporting the rate the receiver can hand it over and the rate
+           including writing it all to the file.'''
+        chunks = self.makeOutput()
+        numBytes = len(chunks) * self.chunkSize
+        directory = tempfile.mkdtemp(dir=self.directory)
+        try:
+            print 'Log writing, %d chunks of %d bytes' % (len(chunks), self.chunkSize)
+            for policy in LogWriter.policies:
+                fileName = os.path.join(directory, policy + '.log')
+                startTime = time.time()
+                writer = LogWriter(fileName, policy)
+                for chunk in chunks:
+                    writer.write(chunk)
+                handedOver = time.time()
+                writer.close()
+                finished = time.time()
+                print '  %-10s receiver %s, complete %s' % (policy,
+                    self.rate(numBytes, handedOver - startTime),
+                    self.rate(numBytes, finished - startTime))
+        finally:
+            shutil.rmtree(directory)
+
+    def matchBenchmark(self):
+        '''Runs a stand in IOC that prints the output a line at a time with
+           a checkpoint every thousand lines.  First waits for each
+           checkpoint in turn, discarding the text up to it, then, on a
+           second run, waits only for the end of the output, which
+           searches the whole of the growing buffer.'''
+        numLines = self.size * 1024 * 1024 / self.chunkSize
+        line = 'x' * (self.chunkSize - 20)
+        script = ("import sys\n"
+            "for i in range(%d):\n"
+            "    if i %% 1000 == 999:\n"
+            "        sys.stdout.write('checkpoint %%d\\n' %% (i / 1000))\n"
+            "    else:\n"
+            "        sys.stdout.write('%%8d %s\\n' %% i)\n"
+            "sys.stdout.write('iocRun: All initialization complete\\n')\n"
+            "sys.stdout.flush()\n"
+            "sys.stdin.read()\n") % (numLines, line)
+        directory = tempfile.mkdtemp(dir=self.directory)
+        try:
+            scriptName = os.path.join(directory, 'ioc.py')
+            open(scriptName, 'w').write(script)
+            print 'Matching, %d lines of %d bytes' % (numLines, self.chunkSize)
+            for checkpoints in [True, False]:
+                startTime = time.time()
+                process = AsynchronousProcess('%s %s' % (sys.executable, scriptName),
+                    directory, name='ioc')
+                # Echoing the output would swamp the measurement
+                process.echo = lambda text: None
+                waits = 0
+                if checkpoints:
+                    for i in range(numLines / 1000):
+                        if not process.waitForStdout(r'checkpoint %d\n' % i, 60.0, True):
+                            print '  Checkpoint %d not found' % i
+                            break
+                        waits += 1
+                found = process.waitForStdout('iocRun: All initialization complete', 120.0, True)
+                waits += 1
+                timeTaken = time.time() - startTime
+                process.kill()
+                print '  %4d waits %s, %.3fs in total, found end %s' % (waits,
+                    self.rate(numLines * self.chunkSize, timeTaken), timeTaken, found is not None)
+        finally:
+            shutil.rmtree(directory)
+
+def main():
+    Benchmark().do()
+
+if __name__ == "__main__":
+    main()
@@ -440,8 +440,11 @@ class Worker(object):
                                 #crateMonitorAddress='172.23.241.1', crateMonitorPort='7032')
                             ioc.start(noStartupScriptWait=True)
                             # Wait for the tests to complete
-                            print 'Waiting for tests to complete...'
-                            ioc.telnetConnection.waitFor('EPICS Test Harness Results', 20*60)
+                            if ioc.bootSequence.state == 'autoboot prompt':
+                                print 'Waiting for tests to complete...'
+                                ioc.bootSequence.run([BootStage('tests complete',
+                                    [re.escape('EPICS Test Harness Results')], 20*60)])
+                            print ioc.bootSequence.describe()
                 # Process the log file
                 print 'Processing log file...'
                 self.tapToJunit('vxTestLog.txt', 'vxTestLog.xml', 'vxWorks')
@@ -467,6 +470,8 @@ class Worker(object):
         '''Run the RTEMS test suite on a remote target.'''
         if self.runRtemsTests:
             startTime = time.time()
+            targetCrashed = False
+            targetOutcome = ''
             # Get the test specs
             specs = self.getTestSpecs()
             if len(specs) > 0:
@@ -489,9 +494,15 @@ class Worker(object):
                                 #crateMonitorAddress='172.23.241.1', crateMonitorPort='7032')
                             ioc.start(noStartupScriptWait=True)
                             # Wait for the tests to complete
-                            print 'Waiting for tests to complete...'
-                            ioc.telnetConnection.waitFor(
-                                ['RTEMS terminated','unrecoverable exception!!!'], 20*60)
+                            if ioc.bootSequence.state == 'started':
+                                print 'Waiting for tests to complete...'
+                                ioc.bootSequence.run([BootStage('tests complete',
+                                    [re.escape('RTEMS terminated')], 20*60)])
+                            print ioc.bootSequence.describe()
+                            if ioc.bootSequence.crashed:
+                                targetCrashed = True
+                            elif ioc.bootSequence.state != 'tests complete':
+                                targetOutcome = 'Boot %s. ' % ioc.bootSequence.state
                             Sleep(5)
                 # Process the log file
                 print 'Processing log file...'
@@ -503,9 +514,9 @@ class Worker(object):
                         self.indexPage.styleSheet)
                     rtemsPage.hrefPage(rtemsPage.body(), rtemsLogPage, 'Console Output')
                     (tests, passes, fails, crashed) = self.tapToHtml('rtemsTestLog.txt', rtemsPage, rtemsLogPage)
-                    result = ''
-                    if crashed:
-                        result = 'Crash detected. '
+                    result = targetOutcome
+                    if crashed or targetCrashed:
+                        result += 'Crash detected. '
                     result += 'Tests=%s, Passes=%s, Fails=%s' % (tests, passes, fails)
                     self.addHtmlReport('Base run tests on RTEMS target.', subPage=rtemsPage,
                         time='%.1fs' % (time.time() - startTime),
@@ -24,9 +24,430 @@ Options:
    -l <name>      Create a summary log file.
    -x             Create junit compatible XML results files.
    --hudson       The tests are being run under Hudson.
+   --concurrent <n> Run up to <n> independent cases of a suite at once.
+   --durations <file> The suite duration history file, defaults to
+                  ".testdurations" in the current directory.
+   --fail-fast <n> Stop testing a target after <n> failures.
+   --max-failures <n> Stop launching suites once <n> cases have failed in
+                  total, the cases of the suites not run are reported
+                  as skipped.
+   --changed <file> Run only the suites affected by the files listed, one
+                  per line, in <file>.
+   --since <range> Run only the suites affected by the files changed in
+                  the git revision range, eg. "origin/master..HEAD".
+   --reuse        Keep IOCs and simulations running between suites, a
+                  suite that starts one with the same command in the same
+                  directory attaches to the running instance.
+   --shard-server <port> Also hand suites out to shard workers connecting
+                  to this TCP port.  Use -p 0 to run no suites locally.
+   --shard-worker <host:port> Run as a shard worker agent, taking suites
+                  from the coordinator at the address.  The -p option
+                  gives the number of suites run at once.
+   --local-workers <n> Start <n> shard workers on this machine, for testing.
+   --json-summary <file> Have the suites send structured result events,
+                  print running totals as suites finish and write a
+                  JSON summary of the run to <file>.
+   --resources    Report the resources used by the test processes in
+                  each case.
+   --log-sync <policy> When the suites synchronise console logs to disc:
+                  always, interval (the default), close or never.
+   --spill <directory> Have the suites write process output to segment
+                  files under the directory, keeping only the most
+                  recent output in memory.
+   --incremental  Have the suites skip builds whose directory is unchanged
+                  since its last successful build.
+   --build-jobs <n> Have the suites run up to <n> builds of a phase at once.
+   --trace        Have each suite write the times of its entity builds,
+                  runs, prepares and destroys as a Chrome trace event
+                  file beside it.
+   --echo <policy> How the suites echo IOC and simulation console output:
+                  all, off, level:<n> or rate:<n> lines a second.
+
+Suites are started longest first according to the durations recorded
+on previous runs.
+
+Each suite records the files it depends on (its entities' databases, IOC
+directories and simulation scripts, plus its Python modules) in a .deps
+file beside it.  With --changed or --since a suite is run only if it or
+one of those files changed, or if it has no .deps file yet.
 '''
 
-import os, sys, subprocess, thread, socket, select, getopt
+import os, sys, subprocess, thread, socket, select, getopt, time, heapq
+import json, tempfile, signal, base64, shutil
+
+class DurationStore(object):
+    '''A small file based record of how long each test suite took on
+    previous runs.  Each line of the file holds a duration in seconds
+    followed by the suite key.  New measurements are smoothed with the
+    stored value so that a single unusual run does not dominate.'''
+
+    smoothing = 0.5
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.durations = {}
+        self.lock = thread.allocate_lock()
+        self.load()
+
+    def load(self):
+        '''Read the stored durations, a missing or damaged file is ignored.'''
+        try:
+            rFile = open(self.fileName, "r")
+        except IOError:
+            pass
+        else:
+            for line in rFile:
+                parts = line.strip().split(' ', 1)
+                if len(parts) == 2:
+                    try:
+                        self.durations[parts[1]] = float(parts[0])
+                    except ValueError:
+                        pass
+            rFile.close()
+
+    def save(self):
+        '''Write the durations, replacing the file in a single step.'''
+        tempFileName = "%s.%s" % (self.fileName, os.getpid())
+        try:
+            wFile = open(tempFileName, "w")
+            for key, duration in sorted(self.durations.iteritems()):
+                wFile.write("%.1f %s\n" % (duration, key))
+            wFile.close()
+            os.rename(tempFileName, self.fileName)
+        except (IOError, OSError):
+            pass
+
+    def get(self, key):
+        '''Returns the expected duration of a suite, or None if unknown.'''
+        return self.durations.get(key)
+
+    def record(self, key, duration):
+        '''Stores a new measurement for the suite and saves the file.'''
+        self.lock.acquire()
+        previous = self.durations.get(key)
+        if previous is not None:
+            duration = self.smoothing * duration + (1.0 - self.smoothing) * previous
+        self.durations[key] = duration
+        self.save()
+        self.lock.release()
+
+    def estimate(self, keys):
+        '''Returns a dictionary of expected durations for the keys.  Suites
+        with no history are assumed to take the average known duration.'''
+        known = [self.durations[k] for k in keys if k in self.durations]
+        default = 0.0
+        if len(known) > 0:
+            default = sum(known) / len(known)
+        result = {}
+        for key in keys:
+            result[key] = self.durations.get(key, default)
+        return result
+
+def predictCompletion(durations, numWorkers):
+    '''Returns the time taken to run the durations, in the order given,
+    on the number of workers when each free worker takes the next item.'''
+    workers = [0.0] * max(numWorkers, 1)
+    for duration in durations:
+        heapq.heapreplace(workers, workers[0] + duration)
+    return max(workers)
+
+class EntityPool(object):
+    '''Keeps IOC and simulation processes running between test suites.
+    Suites talk to the pool over a UNIX socket, one JSON object per line.
+    An 'acquire' request names the kind of entity, its directory and
+    command; a matching idle instance is handed over if one is still
+    running, otherwise a new one is started.  A request marked fresh,
+    made when the entity has just been rebuilt, kills the matching idle
+    instances and always starts a new one.  The reply gives the
+    instance id, its pid, whether it was reused and the names of the
+    files receiving its stdout and stderr and of the FIFO feeding its
+    stdin.  A 'release' request returns the instance to the pool.
+    Instances are only shared between suites with the same environment,
+    less the variables the shell changes from process to process.'''
+    volatileEnvironment = ['PWD', 'OLDPWD', 'SHLVL', '_']
+
+    def __init__(self, socketName):
+        self.socketName = socketName
+        self.directory = tempfile.mkdtemp(prefix='entityPool')
+        self.instances = {}
+        self.nextId = 0
+        self.lock = thread.allocate_lock()
+
+    def start(self):
+        '''Starts the pool server thread.'''
+        try:
+            os.remove(self.socketName)
+        except:
+            pass
+        self.serverSocket = socket.socket(socket.AF_UNIX)
+        self.serverSocket.bind((self.socketName))
+        self.serverSocket.listen(5)
+        thread.start_new_thread(self.server, ())
+
+    def server(self):
+        while True:
+            connection = self.serverSocket.accept()
+            thread.start_new_thread(self.processRequests, (connection[0],))
+
+    def processRequests(self, clientSocket):
+        '''Handles the requests of a single test suite.  Anything it
+        still holds when it disconnects is released.'''
+        held = set()
+        rFile = clientSocket.makefile('r')
+        for line in rFile:
+            try:
+                request = json.loads(line)
+                if request['op'] == 'acquire':
+                    reply = self.acquire(request['kind'], request['directory'],
+                        request['command'], request.get('environment'),
+                        request.get('fresh', False))
+                    held.add(reply['id'])
+                elif request['op'] == 'release':
+                    self.release(request['id'])
+                    held.discard(request['id'])
+                    reply = {'id': request['id']}
+                else:
+                    reply = {'error': 'unknown request'}
+            except Exception, e:
+                reply = {'error': str(e)}
+            clientSocket.sendall(json.dumps(reply) + '\n')
+        for id in held:
+            self.release(id)
+        clientSocket.close()
+
+    def acquire(self, kind, directory, command, environment, fresh=False):
+        '''Returns the details of a running instance, starting one if
+        there is no idle instance with the same kind, directory, command
+        and environment.  If fresh is set, those idle instances are
+        killed rather than reused.'''
+        key = (kind, os.path.abspath(directory), command,
+            tuple(sorted([(name, value) for name, value in (environment or {}).iteritems()
+                if name not in EntityPool.volatileEnvironment])))
+        self.lock.acquire()
+        try:
+            for id, instance in self.instances.items():
+                if instance['process'].poll() is not None:
+                    # It has died, forget about it
+                    self.discard(id)
+                elif instance['key'] == key and not instance['busy'] and fresh:
+                    # Started before a rebuild
+                    self.discard(id)
+                elif instance['key'] == key and not instance['busy']:
+                    instance['busy'] = True
+                    return self.describe(id, True)
+            self.nextId += 1
+            id = self.nextId
+            self.instances[id] = self.spawn(key, id, environment)
+            return self.describe(id, False)
+        finally:
+            self.lock.release()
+
+    def spawn(self, key, id, environment):
+        '''Starts a new instance in its own session with its output going
+        to files.  The pool holds the stdin FIFO open for writing so that
+        the process never sees end of file on it.'''
+        base = os.path.join(self.directory, str(id))
+        os.mkfifo(base + '.stdin')
+        stdinFd = os.open(base + '.stdin', os.O_RDWR)
+        stdoutFile = open(base + '.stdout', 'w')
+        stderrFile = open(base + '.stderr', 'w')
+        process = subprocess.Popen(key[2], cwd=key[1], shell=True, env=environment,
+            stdin=stdinFd, stdout=stdoutFile, stderr=stderrFile, preexec_fn=os.setsid)
+        stdoutFile.close()
+        stderrFile.close()
+        print "Pool started %s %s in %s, pid %s" % (key[0], key[2], key[1], process.pid)
+        return {'key': key, 'process': process, 'busy': True, 'stdinFd': stdinFd,
+            'base': base}
+
+    def describe(self, id, reused):
+        instance = self.instances[id]
+        base = instance['base']
+        return {'id': id, 'pid': instance['process'].pid, 'reused': reused,
+            'stdout': base + '.stdout', 'stderr': base + '.stderr',
+            'stdin': base + '.stdin'}
+
+    def discard(self, id):
+        '''Kills the instance if it is still running and removes its
+        files.  Called with the lock held.'''
+        instance = self.instances.pop(id)
+        try:
+            os.killpg(instance['process'].pid, signal.SIGKILL)
+        except OSError:
+            pass
+        instance['process'].wait()
+        os.close(instance['stdinFd'])
+        for suffix in ('.stdin', '.stdout', '.stderr'):
+            try:
+                os.remove(instance['base'] + suffix)
+            except OSError:
+                pass
+
+    def release(self, id):
+        '''Makes the instance available to the next suite.'''
+        self.lock.acquire()
+        if id in self.instances:
+            self.instances[id]['busy'] = False
+        self.lock.release()
+
+    def shutdown(self):
+        '''Kills all the pooled processes and removes their files.'''
+        self.lock.acquire()
+        for id in self.instances.keys():
+            self.discard(id)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.lock.release()
+
+class ResultStream(object):
+    '''Processes the TAP stream from a single test suite.'''
+
+    def __init__(self, runTests):
+        self.runTests = runTests
+        runTests.resultsLock.acquire()
+        runTests.resultServerCount += 1
+        self.id = runTests.resultServerCount
+        runTests.resultsLock.release()
+        self.tempFile = None
+        self.tempFileName = "%s.%s"%(runTests.summaryLogFile, self.id)
+        if runTests.summaryLogFile is not None:
+            self.tempFile = open(self.tempFileName, "w+")
+        self.partialLine = ''
+        self.suites = {}
+        self.failures = 0
+        self.summaries = []
+
+    def write(self, text):
+        '''Handles the next piece of the TAP text.'''
+        lines = (self.partialLine + text).split('\n')
+        self.partialLine = lines[-1]
+        for line in lines[:-1]:
+            self.processLine(line)
+
+    def processLine(self, line):
+        '''Handles a complete line.  Structured events are passed on, the
+        TAP text is stored, echoed and checked for failures.'''
+        if line.startswith('#@ '):
+            try:
+                event = json.loads(line[3:])
+            except ValueError:
+                pass
+            else:
+                self.processEvent(event)
+            return
+        if self.tempFile is not None:
+            self.tempFile.write(line + '\n')
+        if line.startswith('not ok'):
+            self.failures += 1
+            self.runTests.countFailures(1)
+        if self.runTests.logOutput and len(line) > 0:
+            print "[%s] %s" % (self.id, line)
+
+    def processEvent(self, event):
+        '''Keeps the per suite timings and totals from the events.'''
+        key = (event.get('suite'), event.get('target'))
+        if event['event'] == 'suite-start':
+            self.suites[key] = {'suite': key[0], 'target': key[1],
+                'cases': event.get('cases'), 'caseResults': []}
+        elif event['event'] == 'case-end' and key in self.suites:
+            self.suites[key]['caseResults'].append({'number': event['number'],
+                'case': event['case'], 'status': event['status'],
+                'duration': event['duration']})
+        elif event['event'] == 'suite-end' and key in self.suites:
+            summary = self.suites.pop(key)
+            for name in ('tests', 'failures', 'skipped', 'duration'):
+                summary[name] = event[name]
+            self.summaries.append(summary)
+            self.runTests.suiteFinished(self.id, summary)
+
+    def discard(self):
+        '''Throws away the results of a run that did not complete, so that
+        a retry does not count them again.'''
+        self.runTests.forgetResults(self.failures, self.summaries)
+        if self.tempFile is not None:
+            self.tempFile.close()
+            os.remove(self.tempFileName)
+
+    def close(self):
+        '''If we have stored the output in a temporary file, now copy it
+        onto the end of the full log file.'''
+        if len(self.partialLine) > 0:
+            self.processLine(self.partialLine)
+            self.partialLine = ''
+        if self.tempFile is not None:
+            self.tempFile.close()
+            self.runTests.logFileLock.acquire()
+            logFile = open(self.runTests.summaryLogFile, "a+")
+            tempFile = open(self.tempFileName, "r")
+            for line in tempFile:
+                logFile.write(line)
+            logFile.close()
+            tempFile.close()
+            self.runTests.logFileLock.release()
+
+class ShardWorker(object):
+    '''A worker agent that runs suites handed out by a RunTests shard
+    coordinator.  Each connection to the coordinator runs one suite at a
+    time: it sends a 'ready' message and gets back either a 'run' message
+    with the command line, directory and log file, or 'done'.  The suite
+    reports to a result socket local to the worker and its TAP text is
+    forwarded to the coordinator in 'tap' messages, base64 encoded as
+    the IOC output it includes need not be valid UTF-8, followed by a
+    'finished' message.'''
+
+    def __init__(self, address, numConnections):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.directory = tempfile.mkdtemp(prefix='shardWorker')
+        try:
+            threads = []
+            for i in range(max(numConnections, 1)):
+                lock = thread.allocate_lock()
+                lock.acquire()
+                thread.start_new_thread(self.connection, (i, lock))
+                threads.append(lock)
+            for lock in threads:
+                lock.acquire()
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connection(self, index, lock):
+        try:
+            coordinator = socket.create_connection(self.address)
+            rFile = coordinator.makefile('r')
+            relayName = os.path.join(self.directory, "resultRelay%s" % index)
+            relay = socket.socket(socket.AF_UNIX)
+            relay.bind((relayName))
+            relay.listen(1)
+            going = True
+            while going:
+                coordinator.sendall(json.dumps({'op': 'ready'}) + '\n')
+                message = json.loads(rFile.readline())
+                if message['op'] == 'run':
+                    self.runSuite(coordinator, relay, relayName, message)
+                else:
+                    going = False
+            coordinator.close()
+        finally:
+            lock.release()
+
+    def runSuite(self, coordinator, relay, relayName, message):
+        '''Runs one suite, forwarding its results.'''
+        startTime = time.time()
+        cmdLine = message['cmd'] % {'resultServer': relayName}
+        p = subprocess.Popen(cmdLine, cwd=message['dir'], shell=True)
+        client = None
+        while client is None and p.poll() is None:
+            if select.select([relay], [], [], 1.0)[0]:
+                client = relay.accept()[0]
+        if client is not None:
+            text = client.recv(4096)
+            while len(text) > 0:
+                coordinator.sendall(json.dumps({'op': 'tap',
+                    'data': base64.b64encode(text)}) + '\n')
+                text = client.recv(4096)
+            client.close()
+        p.wait()
+        coordinator.sendall(json.dumps({'op': 'finished',
+            'duration': time.time() - startTime}) + '\n')
 
 class RunTests(object):
 
@@ -60,17 +481,57 @@ class RunTests(object):
         self.summaryLogFile = None
         self.xmlResultFiles = False
         self.underHudson = False
+        self.maxConcurrentCases = 1
+        self.durationsFile = os.path.join(os.getcwd(), ".testdurations")
+        self.failFast = 0
+        self.maxFailures = 0
+        self.totalFailures = 0
+        self.aborted = False
+        self.changedFilesName = None
+        self.changedRange = None
+        self.changedFiles = None
+        self.changedRepositories = set()
+        self.reuseEntities = False
+        self.entityPool = None
+        self.shardServerPort = None
+        self.shardWorkerAddress = None
+        self.numLocalWorkers = 0
+        self.jsonSummaryFile = None
+        self.sampleResources = False
+        self.logSyncPolicy = None
+        self.spillDirectory = None
+        self.echoPolicy = None
+        self.incrementalBuild = False
+        self.buildJobs = None
+        self.traceFiles = False
+        self.suiteSummaries = []
+        self.totals = {'suites': 0, 'tests': 0, 'failures': 0, 'skipped': 0}
         if self.processArguments():
+            if self.shardWorkerAddress is not None:
+                ShardWorker(self.shardWorkerAddress, self.numTestProcesses)
+                return
             self.useConfigFile()
+            self.durationStore = DurationStore(self.durationsFile)
             # Create some lock objects
             self.getCmdLock = thread.allocate_lock()
             self.logFileLock = thread.allocate_lock()
             self.resultsLock = thread.allocate_lock()
             # Start the results server thread
             self.resultServer = thread.start_new_thread(self.resultServer, ())
+            # Start the entity pool
+            if self.reuseEntities:
+                self.entityPool = EntityPool(os.getcwd() + "/entityPool")
+                self.entityPool.start()
             # Get the command list
             self.testCommands = []
             self.determineTestCommands()
+            self.scheduleTestCommands()
+            self.outstanding = len(self.testCommands)
+            # Local runners are counted before any shard worker can be lost
+            self.localRunners = self.numTestProcesses
+            # Start handing out commands to shard workers
+            if self.shardServerPort is not None or self.numLocalWorkers > 0:
+                self.startShardServer()
             # Start the execution threads
             for i in range(self.numTestProcesses):
                 lock = thread.allocate_lock()
@@ -82,11 +543,18 @@ class RunTests(object):
                 lock.acquire()
             for t, lock in self.runTestThreads.iteritems():
                 lock.release()
+            # And until the shard workers have finished theirs
+            while self.outstanding > 0:
+                time.sleep(1.0)
             # Now wait until the result processing threads are complete
             for t, lock in self.resultProcessThreads.iteritems():
                 lock.acquire()
             for t, lock in self.resultProcessThreads.iteritems():
                 lock.release()
+            if self.entityPool is not None:
+                self.entityPool.shutdown()
+            if self.jsonSummaryFile is not None:
+                self.writeJsonSummary()
 
     def getTestCmd(self):
         '''Returns the next test command to run.'''
@@ -98,16 +566,130 @@ class RunTests(object):
         self.getCmdLock.release()
         return result;
 
+    def getLocalTestCmd(self):
+        '''Returns the next test command to run locally.  When none remain
+        the caller stops being counted as a local runner, in the same
+        step so that a suite requeued by a lost shard worker is never
+        left without a runner.'''
+        self.getCmdLock.acquire()
+        result = None
+        if len(self.testCommands) > 0:
+            result = self.testCommands.pop(0)
+        else:
+            self.localRunners -= 1
+        self.getCmdLock.release()
+        return result
+
     def runTest(self, lock):
         '''This function runs tests until no more remain.  It is
         designed to run as a seperate thread.'''
-        cmd = self.getTestCmd()
+        cmd = self.getLocalTestCmd()
         while cmd is not None:
-            p = subprocess.Popen(cmd[0], cwd=cmd[1], shell=True)
+            startTime = time.time()
+            aborted = self.aborted
+            cmdLine = self.commandLine(cmd, aborted, True) % {'resultServer': self.serverSocketName}
+            p = subprocess.Popen(cmdLine, cwd=cmd[1], shell=True)
             p.wait()
-            cmd = self.getTestCmd()
+            self.finishedTestCmd(cmd, aborted, time.time() - startTime)
+            cmd = self.getLocalTestCmd()
         lock.release()
 
+    def commandLine(self, cmd, aborted, local):
+        '''Returns the shell command line for a test command.  The result
+        server socket name is left as the %(resultServer)s format key.
+        Only local suites can use the entity pool.'''
+        cmdLine = cmd[0].replace('%', '%%') + " -r %(resultServer)s"
+        if local and self.entityPool is not None:
+            cmdLine += " --pool " + self.entityPool.socketName
+        if aborted:
+            # Just report the cases as skipped
+            cmdLine += " --skip-all"
+        if self.logOutput:
+            cmdLine += " &> %s" % cmd[3].replace('%', '%%')
+        return cmdLine
+
+    def finishedTestCmd(self, cmd, aborted, duration):
+        '''Records the completion of a test command.'''
+        if not aborted:
+            self.durationStore.record(cmd[2], duration)
+        self.getCmdLock.acquire()
+        self.outstanding -= 1
+        self.getCmdLock.release()
+
+    def startShardServer(self):
+        '''Starts the thread that accepts shard worker connections and
+        any local workers.'''
+        self.shardSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.shardSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.shardSocket.bind(('', self.shardServerPort or 0))
+        self.shardSocket.listen(5)
+        port = self.shardSocket.getsockname()[1]
+        print "Shard coordinator listening on port %s" % port
+        thread.start_new_thread(self.shardServer, ())
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        for i in range(self.numLocalWorkers):
+            subprocess.Popen([sys.executable, script, '--shard-worker',
+                'localhost:%s' % port])
+
+    def shardServer(self):
+        while True:
+            connection = self.shardSocket.accept()
+            thread.start_new_thread(self.serveShardWorker, (connection[0], connection[1]))
+
+    def serveShardWorker(self, workerSocket, address):
+        '''Hands test commands to one shard worker connection.  If the
+        worker goes away part way through a suite, the suite is put back
+        on the queue.'''
+        rFile = workerSocket.makefile('r')
+        cmd = None
+        stream = None
+        try:
+            for line in rFile:
+                message = json.loads(line)
+                if message['op'] == 'ready':
+                    cmd = self.getTestCmd()
+                    if cmd is None:
+                        workerSocket.sendall(json.dumps({'op': 'done'}) + '\n')
+                        break
+                    aborted = self.aborted
+                    print "Running %s on %s" % (cmd[2], address[0])
+                    stream = ResultStream(self)
+                    workerSocket.sendall(json.dumps({'op': 'run', 'dir': os.path.abspath(cmd[1]),
+                        'cmd': self.commandLine(cmd, aborted, False)}) + '\n')
+                elif message['op'] == 'tap' and stream is not None:
+                    stream.write(base64.b64decode(message['data']))
+                elif message['op'] == 'finished' and cmd is not None:
+                    stream.close()
+                    stream = None
+                    self.finishedTestCmd(cmd, aborted, message['duration'])
+                    cmd = None
+        finally:
+            workerSocket.close()
+            if stream is not None:
+                stream.discard()
+            if cmd is not None:
+                print "Lost shard worker %s, requeuing %s" % (address[0], cmd[2])
+                self.getCmdLock.acquire()
+                self.testCommands.insert(0, cmd)
+                if self.localRunners == 0:
+                    # Nothing local is left to pick it up, so start something
+                    self.localRunners += 1
+                    lock = thread.allocate_lock()
+                    lock.acquire()
+                    thread.start_new_thread(self.runTest, (lock,))
+                self.getCmdLock.release()
+
+    def scheduleTestCommands(self):
+        '''Orders the test commands longest first using the recorded
+        durations and prints the predicted completion time.'''
+        estimates = self.durationStore.estimate([c[2] for c in self.testCommands])
+        self.testCommands.sort(key=lambda c: estimates[c[2]], reverse=True)
+        predicted = predictCompletion([estimates[c[2]] for c in self.testCommands],
+            self.numTestProcesses)
+        if predicted > 0.0:
+            print "Predicted completion in %.0fs at %s" % (predicted,
+                time.strftime("%H:%M:%S", time.localtime(time.time() + predicted)))
+
     def determineTestCommands(self):
         '''Scans the modules and builds a list containing the commands that
         should be run to execute the test suites.'''
@@ -135,6 +717,12 @@ class RunTests(object):
                             path = '.' + testSubPath + file
                             log = '.' + testSubPath + fileParts[0] + '.log'
                             xmlResults = '.' + testSubPath + fileParts[0] + '.xml'
+                            trace = '.' + testSubPath + fileParts[0] + '.trace.json'
+                            deps = '.' + testSubPath + fileParts[0] + '.deps'
+                            if not self.isAffected(moduleDir, testDir + file,
+                                    testDir + fileParts[0] + '.deps'):
+                                print "Skipping unaffected suite %s" % (module + testSubPath + file)
+                                continue
                             options = "-d %s" % self.diagnosticLevel
                             if self.build:
                                 options += " -b"
@@ -150,28 +738,99 @@ class RunTests(object):
                             if self.testCase is not None:
                                 options += " -c "
                                 options += self.testCase
-                            if self.serverSocketName is not None:
-                                options += " -r "
-                                options += self.serverSocketName
                             if self.xmlResultFiles:
                                 options += " -x "
                                 options += xmlResults
                             if self.underHudson:
                                 options += " --hudson"
+                            if self.maxConcurrentCases > 1:
+                                options += " --concurrent %s" % self.maxConcurrentCases
+                            if self.failFast > 0:
+                                options += " --fail-fast %s" % self.failFast
+                            options += " --deps " + deps
+                            if self.jsonSummaryFile is not None:
+                                options += " --events"
+                            if self.sampleResources:
+                                options += " --resources"
+                            if self.logSyncPolicy is not None:
+                                options += " --log-sync " + self.logSyncPolicy
+                            if self.spillDirectory is not None:
+                                options += " --spill " + self.spillDirectory
+                            if self.echoPolicy is not None:
+                                options += " --echo " + self.echoPolicy
+                            if self.incrementalBuild:
+                                options += " --incremental"
+                            if self.buildJobs is not None:
+                                options += " --build-jobs %s" % self.buildJobs
+                            if self.traceFiles:
+                                options += " --trace " + trace
                             cmd = ""
                             for export in self.exports:
                                 cmd += export + " "
                             cmd += "dls-python2.6 %s %s" % (path, options)
-                            if self.logOutput:
-                                cmd += " &> %s" % (log)
-                            self.testCommands.append((cmd, moduleDir))
+                            self.testCommands.append((cmd, moduleDir,
+                                module + testSubPath + file, log))
+
+    def isAffected(self, moduleDir, suiteFileName, depsFileName):
+        '''Returns True if the suite may be affected by the changed files.
+        Always True when no change selection has been requested.'''
+        if self.changedFilesName is None and self.changedRange is None:
+            return True
+        changed = self.getChangedFiles(moduleDir)
+        if os.path.abspath(suiteFileName) in changed:
+            return True
+        try:
+            rFile = open(depsFileName, "r")
+        except IOError:
+            # Nothing recorded so we cannot rule it out
+            return True
+        dependencies = [line.strip() for line in rFile if len(line.strip()) > 0]
+        rFile.close()
+        for path in changed:
+            for dependency in dependencies:
+                if path == dependency or path.startswith(dependency + os.sep):
+                    return True
+        return False
+
+    def getChangedFiles(self, moduleDir):
+        '''Returns the set of absolute paths of the changed files, querying
+        git for the repository containing the module if a revision
+        range was given.'''
+        if self.changedFiles is None:
+            self.changedFiles = set()
+            if self.changedFilesName is not None:
+                try:
+                    rFile = open(self.changedFilesName, "r")
+                except IOError:
+                    print "Failed to open file \"%s\"" % self.changedFilesName
+                else:
+                    for line in rFile:
+                        if len(line.strip()) > 0:
+                            self.changedFiles.add(os.path.abspath(line.strip()))
+                    rFile.close()
+        if self.changedRange is not None:
+            topLevel = subprocess.Popen('git rev-parse --show-toplevel', cwd=moduleDir,
+                shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+            if len(topLevel) > 0 and topLevel not in self.changedRepositories:
+                self.changedRepositories.add(topLevel)
+                text = subprocess.Popen('git diff --name-only %s' % self.changedRange,
+                    cwd=topLevel, shell=True, stdout=subprocess.PIPE).communicate()[0]
+                for line in text.split('\n'):
+                    if len(line.strip()) > 0:
+                        self.changedFiles.add(os.path.join(topLevel, line.strip()))
+        return self.changedFiles
 
     def processArguments(self):
         """Process the command line arguments.
         """
         try:
             opts, args = getopt.gnu_getopt(sys.argv[1:], 'm:d:t:c:hbiges:f:p:l:xq',
-                ['help', 'hudson', 'target=', 'case=', 'build', 'ioc', 'gui', 'simulation', 'module='])
+                ['help', 'hudson', 'target=', 'case=', 'build', 'ioc', 'gui', 'simulation', 'module=',
+                'concurrent=', 'durations=',
+                'fail-fast=', 'max-failures=', 'changed=', 'since=',
+                'reuse', 'shard-server=', 'shard-worker=', 'local-workers=',
+                'json-summary=', 'resources', 'log-sync=', 'spill=', 'echo=',
+                'incremental', 'build-jobs=', 'trace'])
         except getopt.GetoptError, err:
             return False
         for o, a in opts:
@@ -208,6 +867,42 @@ class RunTests(object):
                 self.xmlResultFiles = True
             elif o in ('-q'):
                 self.logOutput = True
+            elif o in ('--concurrent'):
+                self.maxConcurrentCases = int(a)
+            elif o in ('--durations'):
+                self.durationsFile = a
+            elif o in ('--fail-fast'):
+                self.failFast = int(a)
+            elif o in ('--max-failures'):
+                self.maxFailures = int(a)
+            elif o in ('--changed'):
+                self.changedFilesName = a
+            elif o in ('--since'):
+                self.changedRange = a
+            elif o in ('--reuse'):
+                self.reuseEntities = True
+            elif o in ('--shard-server'):
+                self.shardServerPort = int(a)
+            elif o in ('--shard-worker'):
+                self.shardWorkerAddress = a
+            elif o in ('--local-workers'):
+                self.numLocalWorkers = int(a)
+            elif o in ('--json-summary'):
+                self.jsonSummaryFile = a
+            elif o in ('--resources'):
+                self.sampleResources = True
+            elif o in ('--log-sync'):
+                self.logSyncPolicy = a
+            elif o in ('--spill'):
+                self.spillDirectory = os.path.abspath(a)
+            elif o in ('--echo'):
+                self.echoPolicy = a
+            elif o in ('--incremental'):
+                self.incrementalBuild = True
+            elif o in ('--build-jobs'):
+                self.buildJobs = int(a)
+            elif o in ('--trace'):
+                self.traceFiles = True
         if len(args) > 0:
             print 'Too many arguments.'
             return False
@@ -235,41 +930,65 @@ class RunTests(object):
 
     def processResults(self, clientSocket, lock):
         """Processes the TAP stream from a single client test suite."""
-        self.resultsLock.acquire()
-        self.resultServerCount += 1
-        myId = self.resultServerCount
-        self.resultsLock.release()
-        tempFile = None
-        tempFileName = "%s.%s"%(self.summaryLogFile, myId)
-        if self.summaryLogFile is not None:
-            tempFile = open(tempFileName, "w+")
+        stream = ResultStream(self)
         going = True
         while going:
             text = clientSocket.recv(4096)
             if len(text) > 0:
-                if tempFile is not None:
-                    tempFile.write(text)
-                if self.logOutput:
-                    lines = text.split('\n')
-                    for line in lines:
-                        if len(line) > 0:
-                            print "[%s] %s" % (myId, line)
+                stream.write(text)
             else:
                 going = False
-        # If we have stored the output in a temporary file, now copy it
-        # onto the end of the full log file.
-        if tempFile is not None:
-            tempFile.close()
-            self.logFileLock.acquire()
-            logFile = open(self.summaryLogFile, "a+")
-            tempFile = open(tempFileName, "r")
-            for line in tempFile:
-                logFile.write(line)
-            logFile.close()
-            tempFile.close()
-            self.logFileLock.release()
+        stream.close()
         lock.release()
 
+    def countFailures(self, failures):
+        '''Counts failing cases, aborting the run if the failure limit
+        is reached.'''
+        self.resultsLock.acquire()
+        self.totalFailures += failures
+        if self.maxFailures > 0 and self.totalFailures >= self.maxFailures and \
+                not self.aborted:
+            print "Aborting after %s failures" % self.totalFailures
+            self.aborted = True
+        self.resultsLock.release()
+
+    def forgetResults(self, failures, summaries):
+        '''Takes back the failures and suite summaries of an incomplete
+        run that is to be retried.'''
+        self.resultsLock.acquire()
+        self.totalFailures -= failures
+        for summary in summaries:
+            self.suiteSummaries.remove(summary)
+            self.totals['suites'] -= 1
+            for name in ('tests', 'failures', 'skipped'):
+                self.totals[name] -= summary[name]
+        self.resultsLock.release()
+
+    def suiteFinished(self, id, summary):
+        '''Records the summary of a suite run against a target and prints
+        the running totals.'''
+        self.resultsLock.acquire()
+        self.suiteSummaries.append(summary)
+        self.totals['suites'] += 1
+        for name in ('tests', 'failures', 'skipped'):
+            self.totals[name] += summary[name]
+        print "[%s] %s/%s: %s tests, %s failures, %s skipped in %.1fs " \
+            "(total %s suites, %s tests, %s failures, %s skipped)" % \
+            (id, summary['suite'], summary['target'], summary['tests'], summary['failures'],
+            summary['skipped'], summary['duration'], self.totals['suites'],
+            self.totals['tests'], self.totals['failures'], self.totals['skipped'])
+        self.resultsLock.release()
+
+    def writeJsonSummary(self):
+        '''Writes the totals and per suite results of the run.'''
+        try:
+            wFile = open(self.jsonSummaryFile, "w")
+        except IOError:
+            print "Failed to open file \"%s\"" % self.jsonSummaryFile
+        else:
+            json.dump({'totals': self.totals, 'suites': self.suiteSummaries}, wFile, indent=2)
+            wFile.close()
+
     def useConfigFile(self):
         """Parse the config file and record the configuration."""
         try:
@@ -291,6 +1010,8 @@ class RunTests(object):
                 self.searchDirectory = g[1].strip()
             elif g[0] == "processes" and len(g) == 2:
                 self.numTestProcesses = int(g[1].strip())
+            elif g[0] == "durations" and len(g) == 2:
+                self.durationsFile = g[1].strip()
 
 if __name__ == "__main__":
     tests = RunTests()
@@ -15,7 +15,8 @@ setup(
     entry_points = {'console_scripts': [
         'dls-run-tests = dls_autotestframework.autotestframework:main',
         'dls-create-coverage-report.py = dls_autotestframework.createcoveragereport:main',
-        'dls-build-epics-base.py = dls_autotestframework.buildepicsbase:main'
+        'dls-build-epics-base.py = dls_autotestframework.buildepicsbase:main',
+        'dls-benchmark.py = dls_autotestframework.benchmark:main'
         ]},
 #    include_package_data = True, # use this to include non python files
     zip_safe = False